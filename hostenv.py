@@ -1,4 +1,5 @@
 import os
+from hostfacts import nic_by_driver
 
 def dst_home(user, env):
     if user == 'root':
@@ -32,6 +33,70 @@ n01 = {'ens5f0': '192.168.11.151/24', 'ens5f1': '192.168.11.152/24'}
 star = [('192.168.20.%d/24'%i) for i in range(2, 10)]
 def_ports = [50000, 60000]
 
+#
+# Host groups that multi-host tasks accept in place of a host name
+#
+host_groups = {
+        'nodes': ['n01', 'n02', 'n29', 'n31', 'n33'],
+        'cl': ['cl0', 'cl1', 'cl2', 'cl3'],
+        }
+
+#
+# Runtime tuning profiles that tune_host applies, see _tunables in tasks.py
+#
+tune_profiles = {
+        'perf': {'governor': 'performance', 'turbo': 'off', 'cstate': '1',
+            'irqbalance': 'inactive', 'thp': 'never'},
+        'turbo': {'governor': 'performance', 'turbo': 'on', 'cstate': '1',
+            'irqbalance': 'inactive', 'thp': 'never'},
+        }
+
+#
+# netmap private allocator sizing
+#
+NM_RING_HDR = 256 # struct netmap_ring up to the slots
+NM_SLOT_SIZE = 16 # struct netmap_slot
+NM_BUF_SIZE = 2048
+NM_IF_SIZE = 1024
+NM_EXTRA_BUFS = 10000 # per core, for applications holding buffers
+NM_MEM_SHARE = 0.5 # of the free memory on the NICs' NUMA nodes
+
+def netmap_priv_sizing(ncpus, nics, memfree):
+    #
+    # nics maps an interface to its 'rxq', 'txq', 'slots' and NUMA 'node',
+    # memfree maps a NUMA node (-1 without NUMA) to its free bytes.
+    # Returns priv_* values and why each one is so, or raises if they would
+    # take more than NM_MEM_SHARE of the free memory.
+    #
+    why = []
+    if_num = max(ncpus * 2, len(nics))
+    why.append('priv_if_num {}: 2 ports per core x {} cores'.format(if_num,
+        ncpus))
+    nic_rings = sum(n['rxq'] + n['txq'] + 2 for n in nics.values())
+    ring_num = if_num * 2 + nic_rings
+    why.append('priv_ring_num {}: tx+rx ring per port ({}) + NIC queues and'
+            ' host rings ({})'.format(ring_num, if_num * 2, nic_rings))
+    slots = max([n['slots'] for n in nics.values() if n['slots']] or [2048])
+    ring_size = NM_RING_HDR + NM_SLOT_SIZE * slots
+    why.append('priv_ring_size {}: {} header + {} slots x {} bytes'.format(
+        ring_size, NM_RING_HDR, slots, NM_SLOT_SIZE))
+    buf_num = ring_num * slots + ncpus * NM_EXTRA_BUFS
+    why.append('priv_buf_num {}: {} rings x {} slots + {} extra x {} cores'
+            .format(buf_num, ring_num, slots, NM_EXTRA_BUFS, ncpus))
+
+    total = (buf_num * NM_BUF_SIZE + ring_num * ring_size +
+            if_num * NM_IF_SIZE)
+    nodes = set(n['node'] for n in nics.values()) & set(memfree)
+    free = min(memfree[x] for x in nodes) if nodes else sum(memfree.values())
+    why.append('total {:.0f} MB of {:.0f} MB free on node(s) {}'.format(
+        total / 2**20, free / 2**20, sorted(nodes) or 'all'))
+    if total > free * NM_MEM_SHARE:
+        raise Exception('netmap needs {:.0f} MB, more than {:.0f}% of {:.0f} MB'
+                ' free:\n  {}'.format(total / 2**20, NM_MEM_SHARE * 100,
+                    free / 2**20, '\n  '.join(why)))
+    return {'priv_if_num': if_num, 'priv_ring_num': ring_num,
+            'priv_ring_size': ring_size, 'priv_buf_num': buf_num}, why
+
 def linux_defaults(env):
     #
     # default values for Linux hosts
@@ -47,6 +112,9 @@ def linux_defaults(env):
     env.linux_config = 'def'
     env.ovs_src = os.path.join(env.workdir, 'ovs')
     env.nozstd = False
+    # used by make_linux/make_netmap --ccache
+    env.ccache_dir = os.path.join(env.workdir, 'ccache')
+    env.ccache_size = '20G'
 
 
     # May fail, set warn_only
@@ -206,6 +274,13 @@ def hostenv(env):
         env.ifs = ['ens1f0']
         if name == 'cl2' or name == 'cl3':
             env.ifs = ['enp6s0f0']
+        # or whichever of these drivers the facts say the host has
+        nic = nic_by_driver(env.facts, ('i40e', 'ixgbe')) if 'facts' in env \
+                else None
+        if nic:
+            env.ifs = [nic[0]]
+            env.nm_modules = [nic[1]]
+            env.nm_no_ext_drivers = env.nm_modules
         env.ifs_addr = {env.ifs[0]:b2b_cl[0][0]}
         if name == 'cl1':
             env.ifs_addr = {env.ifs[0]:b2b_cl[0][1]}
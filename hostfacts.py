@@ -0,0 +1,135 @@
+import base64
+
+#
+# Facts of a host gathered by a single remote script: OS, CPU topology and,
+# on Linux, each NIC's driver, firmware, link, queues, rings, NUMA node,
+# PCIe link and addresses
+#
+facts_script = r'''
+echo "@@sys $(uname -s) $(uname -r)"
+echo "@@boot_id $(cat /proc/sys/kernel/random/boot_id 2>/dev/null || sysctl -n kern.boottime)"
+echo "@@ncpus $(getconf _NPROCESSORS_ONLN 2>/dev/null || sysctl -n hw.ncpu)"
+for c in /sys/devices/system/cpu/cpu[0-9]*; do
+    [ "$(cat $c/online 2>/dev/null || echo 1)" = 1 ] || continue
+    [ -e $c/topology/core_id ] || continue
+    n=$(ls -d $c/node[0-9]* 2>/dev/null | sed 's/.*node//')
+    echo "@@cpu ${c##*cpu} $(cat $c/topology/core_id) $(cat $c/topology/physical_package_id) ${n:--1} $(cat $c/topology/thread_siblings_list)"
+done
+for d in /sys/class/net/*; do
+    [ -e $d/device ] || continue
+    i=${d##*/}
+    echo "@@if $i"
+    echo "mac $(cat $d/address)"
+    echo "node $(cat $d/device/numa_node 2>/dev/null)"
+    echo "speed $(cat $d/speed 2>/dev/null)"
+    echo "pci $(basename $(readlink $d/device))"
+    echo "pcie $(cat $d/device/current_link_width 2>/dev/null) $(cat $d/device/current_link_speed 2>/dev/null)"
+    ip -o addr show dev $i 2>/dev/null | while read n x f a r; do echo "addr $f $a"; done
+    ethtool -i $i 2>/dev/null | sed 's/^/i /'
+    ethtool -l $i 2>/dev/null | sed 's/^/l /'
+    ethtool -g $i 2>/dev/null | sed 's/^/g /'
+done
+'''
+
+def facts_cmd():
+    return 'sh -c "echo {} | base64 -d | sh"'.format(
+            base64.b64encode(facts_script.encode()).decode())
+
+def _int(s):
+    return int(s) if s.lstrip('-').isdigit() else None
+
+def _ethtool_current(lines):
+    # {key: value} of Pre-set maximums and Current hardware settings
+    cur, mx = {}, {}
+    d = None
+    for l in lines:
+        if l.startswith('Pre-set maximums'):
+            d = mx
+        elif l.startswith('Current hardware settings'):
+            d = cur
+        elif d is not None and ':' in l:
+            k, _, v = l.partition(':')
+            d[k.strip().lower()] = _int(v.strip())
+    return cur, mx
+
+def _parse_nic(lines):
+    nic = {'addrs': [], 'driver': None, 'firmware': None}
+    info, chans, rings = [], [], []
+    for l in lines:
+        k, _, v = l.partition(' ')
+        if k == 'mac':
+            nic['mac'] = v
+        elif k in ('node', 'speed'):
+            nic[k] = _int(v)
+        elif k == 'pci':
+            nic['bus'] = v
+        elif k == 'pcie':
+            # 8 8.0 GT/s PCIe
+            t = v.split()
+            nic['pcie'] = {'width': _int(t[0]) if t else None,
+                    'speed': ' '.join(t[1:3]) or None}
+        elif k == 'addr':
+            f, a = v.split()
+            nic['addrs'].append({'family': f, 'addr': a})
+        elif k == 'i':
+            ik, _, iv = v.partition(':')
+            info.append((ik.strip(), iv.strip()))
+        elif k == 'l':
+            chans.append(v)
+        elif k == 'g':
+            rings.append(v)
+    info = dict(info)
+    nic['driver'] = info.get('driver')
+    nic['version'] = info.get('version')
+    nic['firmware'] = info.get('firmware-version')
+    nic['queues'], nic['max_queues'] = _ethtool_current(chans)
+    nic['rings'], nic['max_rings'] = _ethtool_current(rings)
+    return nic
+
+def parse_facts(out):
+    facts = {'ostype': None, 'nics': {}, 'cpus': [], 'nodes': {}}
+    cur = None
+    for l in out.splitlines():
+        if not l.startswith('@@'):
+            if cur is not None:
+                cur.append(l.strip())
+            continue
+        k, _, v = l[2:].partition(' ')
+        cur = None
+        if k == 'sys':
+            t = v.split()
+            facts['ostype'] = t[0]
+            facts['release'] = t[1] if len(t) > 1 else None
+        elif k == 'boot_id':
+            facts['boot_id'] = v.strip()
+        elif k == 'ncpus':
+            facts['ncpus'] = _int(v.strip())
+        elif k == 'cpu':
+            cpu, core, sock, node, sib = v.split()
+            facts['cpus'].append({'cpu': int(cpu), 'core': int(core),
+                'socket': int(sock), 'node': int(node), 'siblings': sib})
+            facts['nodes'].setdefault(node, []).append(int(cpu))
+        elif k == 'if':
+            cur = facts['nics'].setdefault(v.strip(), [])
+    for i, lines in facts['nics'].items():
+        facts['nics'][i] = _parse_nic(lines)
+    facts['cpus'].sort(key=lambda x: x['cpu'])
+    return facts
+
+def gather_facts(c):
+    return parse_facts(c.run(facts_cmd(), hide='both').stdout)
+
+def nic_by_driver(facts, drivers):
+    # first NIC driven by one of drivers, as (name, driver)
+    for i, n in sorted(facts.get('nics', {}).items()):
+        if n['driver'] in drivers:
+            return i, n['driver']
+    return None
+
+def nic_by_addr(facts, prefix):
+    # NIC that has an address starting with prefix, as (name, driver, addr)
+    for i, n in sorted(facts.get('nics', {}).items()):
+        for a in n['addrs']:
+            if a['addr'].startswith(prefix):
+                return i, n['driver'], a['addr']
+    return None
@@ -1,6 +1,7 @@
 from invoke import task
 from fabric import Connection
 from patchwork import files
+from hostfacts import gather_facts, nic_by_driver
 import os
 import time
 import re
@@ -60,19 +61,18 @@ def setup(c):
     c = Connection('localhost')
     c.netmap_src = os.path.join(c.run('pwd', hide='both').stdout.strip(),
             'deployed/netmap')
-    # identify node type
-    r = c.run('uname -a').stdout
-    if re.search('c220g2', r):
-        c.ifs = ['enp6s0f0']
-        c.netmap_modules = ['ixgbe']
-    elif re.search('c220g5', r):
-        c.ifs = ['ens1f0']
-        c.netmap_modules = ['i40e']
-    # remember the IP address
-    a = c.run("ip addr show dev {} | grep inet | grep -v inet6 "
-              "| tr -s ' ' | cut -d ' ' -f3".format(c.ifs[0]),
-              echo=True, warn=True).stdout.strip('\n')
-    c.ifs_addr = {c.ifs[0]:a} if len(a) else {c.ifs[0]:'10.10.1.1/24'}
+    # identify the NIC by its driver and remember the IP address
+    facts = gather_facts(c)
+    drivers = ('ixgbe', 'i40e')
+    nic = nic_by_driver(facts, drivers)
+    if nic is None:
+        raise Exception('No NIC driven by {}'.format(' or '.join(drivers)))
+    ifname, driver = nic
+    c.ifs = [ifname]
+    c.netmap_modules = [driver]
+    a = [x['addr'] for x in facts['nics'][ifname]['addrs']
+            if x['family'] == 'inet']
+    c.ifs_addr = {c.ifs[0]:a[0]} if a else {c.ifs[0]:'10.10.1.1/24'}
 
     singleq = True
     lowintr = False # don't enable for i40e driver
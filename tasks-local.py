@@ -1,6 +1,7 @@
 from invoke import task
 from fabric import Connection
 from patchwork import files
+from hostfacts import gather_facts, nic_by_addr
 import os
 import time
 import re
@@ -60,14 +61,12 @@ def setup(c):
     c = Connection('localhost')
     c.netmap_src = os.path.join(c.run('pwd', hide='both').stdout.strip(),
             'deployed/netmap')
-    # identify the NIC name
-    cmd = ('ip addr show to 10.10.1.0/24 | grep ^[0-9]: | cut -d " " -f2'
-          ' | sed "s/:$//"')
-    ifname = c.run(cmd, echo=True).stdout.strip()
-    cmd = 'ethtool -i {} | grep ^drive | cut -d: -f2 | tr -d " "'.format(ifname)
-    driver = c.run(cmd, echo=True).stdout.strip()
-    cmd = 'ip addr show to 10.10.1.0/24 | grep inet | tr -s " " | cut -d" " -f3'
-    addr = c.run(cmd, echo=True).stdout.strip()
+    # identify the NIC, its driver and address
+    facts = gather_facts(c)
+    nic = nic_by_addr(facts, '10.10.1.')
+    if nic is None:
+        raise Exception('No NIC has an address in 10.10.1.0/24')
+    ifname, driver, addr = nic
     c.ifs = [ifname]
     c.netmap_modules = [driver]
     c.ifs_addr = {c.ifs[0]:addr}
@@ -27,14 +27,39 @@
 # SUCH DAMAGE.
 
 from invoke import task
-from fabric import Connection
+from invoke.runners import Result
+from invoke.exceptions import UnexpectedExit
+from fabric import Connection, ThreadingGroup, GroupResult
+from fabric.exceptions import GroupException
 from patchwork import files
-from hostenv import hostenv
+from hostenv import hostenv, host_groups, netmap_priv_sizing, def_ports
+from hostenv import tune_profiles
+from hostfacts import gather_facts
 import re
 import os
 import time
+import json
+import io
+import sys
+import base64
+import hashlib
+import difflib
+import tarfile
+import threading
+import atexit
+import itertools
+import math
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from patchwork.transfers import rsync
 from pathlib import Path
+from contextlib import contextmanager
+
+# Local store of per-host facts, keyed by host and boot ID
+CACHE_DIR = os.path.expanduser('~/.cache/fabric')
+FACT_CACHE = os.path.join(CACHE_DIR, 'hostfacts.json')
+FACT_TTL = 24 * 3600
+_cache_lock = threading.Lock()
 
 def is_freebsd(c):
     return c.ostype == 'FreeBSD'
@@ -48,45 +73,347 @@ def ensure_connected(c, host):
         _hostenv(c)
     return c
 
+class _PrefixedStream(object):
+    # Prefix each line written to stream
+    def __init__(self, stream, prefix):
+        self.stream = stream
+        self.prefix = prefix
+        self.buf = ''
+
+    def write(self, s):
+        lines = (self.buf + s).split('\n')
+        self.buf = lines.pop()
+        for l in lines:
+            self.stream.write('{} {}\n'.format(self.prefix, l))
+        return len(s)
+
+    def flush(self):
+        if self.buf:
+            self.stream.write('{} {}\n'.format(self.prefix, self.buf))
+            self.buf = ''
+        self.stream.flush()
+
+    def __getattr__(self, k):
+        return getattr(self.stream, k)
+
+class _ThreadStream(object):
+    # Send writes to the stream registered for the current thread
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def _get(self):
+        return getattr(self.local, 'stream', self.stream)
+
+    def write(self, s):
+        return self._get().write(s)
+
+    def flush(self):
+        self._get().flush()
+
+    def __getattr__(self, k):
+        return getattr(self._get(), k)
+
+def _host_list(host):
+    # comma-separated host names and/or group names in hostenv.host_groups
+    hosts = []
+    for h in host.split(','):
+        for hh in host_groups.get(h, [h]):
+            if hh not in hosts:
+                hosts.append(hh)
+    return hosts
+
+def _is_multi(host):
+    return bool(host) and len(_host_list(host)) > 1
+
+def _fanout(fn, host, par=8, **kwargs):
+    hosts = _host_list(host)
+    elapsed = {}
+
+    def worker(cx):
+        prefix = '[{}]'.format(cx.original_host)
+        for k, ts in ('out_stream', sys.stdout), ('err_stream', sys.stderr):
+            ts.local.stream = _PrefixedStream(ts.stream, prefix)
+            cx.config.run[k] = ts.local.stream
+        t = time.time()
+        try:
+            _hostenv(cx)
+            return fn(cx, **kwargs)
+        finally:
+            elapsed[cx.original_host] = time.time() - t
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _ThreadStream(saved[0]), _ThreadStream(saved[1])
+    results = GroupResult()
+    try:
+        with ThreadPoolExecutor(max_workers=int(par)) as ex:
+            futures = [(cx, ex.submit(worker, cx))
+                    for cx in ThreadingGroup(*hosts)]
+            for cx, f in futures:
+                try:
+                    results[cx] = f.result()
+                except Exception as e:
+                    results[cx] = e
+    finally:
+        sys.stdout, sys.stderr = saved
+
+    print('{}: {} host(s), {} failed'.format(fn.__name__.lstrip('_'),
+        len(hosts), len(results.failed)))
+    for cx, r in results.items():
+        h = cx.original_host
+        if cx in results.failed:
+            print('  {:<8} FAILED {:8.1f}s  {!r}'.format(h, elapsed[h], r))
+        else:
+            print('  {:<8} ok     {:8.1f}s'.format(h, elapsed[h]))
+    if results.failed:
+        raise GroupException(results)
+    return results
+
+#
+# FAB_TRACE=1 times every run/sudo/local/put/get and rsync_upload and ranks
+# them at exit, FAB_TRACE=file.json also writes them as a Chrome trace
+#
+TRACE = os.environ.get('FAB_TRACE')
+_trace = []
+_trace_local = threading.local()
+
+def _caller():
+    # innermost function of this file outside the tracing itself
+    f = sys._getframe(1)
+    while f and (f.f_code.co_filename != __file__ or
+            f.f_code.co_name in ('_caller', '_traced', 'traced')):
+        f = f.f_back
+    return f.f_code.co_name if f else '?'
+
+@contextmanager
+def _traced(op, host, what):
+    # operations inside a traced one are part of it
+    if not TRACE or getattr(_trace_local, 'busy', False):
+        yield {}
+        return
+    ent = {'op': op, 'host': host, 'cmd': what, 'fn': _caller(),
+            'tid': threading.current_thread().name, 'bytes': None,
+            'exited': None}
+    _trace_local.busy = True
+    t = time.time()
+    try:
+        yield ent
+    except UnexpectedExit as e:
+        ent['exited'] = e.result.exited
+        raise
+    finally:
+        ent['start'], ent['dur'] = t, time.time() - t
+        _trace_local.busy = False
+        _trace.append(ent)
+
+def _xfer_bytes(x):
+    if isinstance(x, str):
+        return os.path.getsize(x) if os.path.isfile(x) else None
+    if hasattr(x, 'getvalue'):
+        return len(x.getvalue())
+    return None
+
+def _trace_conn(c):
+    # override the operations of this Connection with timed ones
+    if not TRACE or getattr(c.run, 'traced', False):
+        return
+    def wrap(op, f):
+        def traced(*args, **kwargs):
+            with _traced(op, c.original_host, str(args[0]) if args else
+                    '') as ent:
+                r = f(*args, **kwargs)
+                if isinstance(r, Result):
+                    ent['exited'] = r.exited
+                    ent['bytes'] = len(r.stdout) + len(r.stderr)
+                elif op in ('put', 'get'):
+                    ent['exited'] = 0
+                    ent['bytes'] = _xfer_bytes(r.local)
+                return r
+        traced.traced = True
+        return traced
+    for op in 'run', 'sudo', 'local', 'put', 'get':
+        setattr(c, op, wrap(op, getattr(c, op)))
+
+def _trace_report():
+    if not _trace:
+        return
+    byfn = {}
+    for e in _trace:
+        st = byfn.setdefault(e['fn'], [0, 0.0, 0])
+        st[0] += 1
+        st[1] += e['dur']
+        st[2] += e['bytes'] or 0
+    total = sum(e['dur'] for e in _trace)
+    print('trace: {} operations, {:.1f}s'.format(len(_trace), total))
+    for fn, (n, t, b) in sorted(byfn.items(), key=lambda x: -x[1][1]):
+        print('  {:<28} {:>5} ops {:>8.1f}s {:>5.1f}% {:>12} bytes'.format(fn,
+            n, t, 100 * t / max(total, 1e-9), b))
+    print('slowest:')
+    for e in sorted(_trace, key=lambda e: -e['dur'])[:10]:
+        print('  {:>8.2f}s {:<8} {:<5} {:>4} {} {}'.format(e['dur'], e['host'],
+            e['op'], '-' if e['exited'] is None else e['exited'], e['fn'],
+            e['cmd'][:60]))
+    if TRACE.endswith('.json'):
+        t0 = min(e['start'] for e in _trace)
+        with open(TRACE, 'w') as f:
+            json.dump({'traceEvents': [{'name': e['cmd'][:80], 'cat': e['op'],
+                'ph': 'X', 'ts': int((e['start'] - t0) * 1e6),
+                'dur': int(e['dur'] * 1e6), 'pid': e['host'],
+                'tid': e['tid'], 'args': {'fn': e['fn'], 'bytes': e['bytes'],
+                    'exited': e['exited']}} for e in _trace]}, f)
+        print('trace: written to {}'.format(TRACE))
+
+if TRACE:
+    atexit.register(_trace_report)
+
 def rsync_upload(c, src, dst, nogit=False, delete=False):
     src = src.rstrip('/') + '/'
     exclude = '.git' if nogit else ''
     ssh_agent = os.environ.get('SSH_AUTH_SOCK', None)
     if ssh_agent:
         c.config['run']['env']['SSH_AUTH_SOCK'] = ssh_agent
-    rsync(c, src, dst, delete=delete, exclude=exclude, rsync_opts='-q',
-            ssh_opts=get_ssh_opts(c))
+    with _traced('rsync', c.original_host, '{} {}'.format(src, dst)) as ent:
+        rsync(c, src, dst, delete=delete, exclude=exclude, rsync_opts='-q',
+                ssh_opts=get_ssh_opts(c))
+        ent['exited'] = 0
 
 def norm(s):
     s = re.sub("^\s+", "", s)
     s = re.sub("\s+", " ", s)
     return s, s.split(' ')[:-1]
 
+def _hash_key(*parts):
+    return hashlib.sha1(' '.join(parts).encode()).hexdigest()[:12]
+
 def ostype_and_ncores(c):
-    ostype = c.run('uname -s', hide='both').stdout.strip()
-    if ostype == 'Linux':
-        r = c.run('cat /proc/cpuinfo | egrep ^processor | wc', hide='both').stdout
-        ncpus = int( norm(r)[1][0] )
-    elif ostype == 'FreeBSD':
-        r = c.run("sysctl hw.ncpu | cut -d' ' -f2", hide=True).stdout
-        ncpus = int(r)
+    facts = host_facts(c)
+    return facts['ostype'], facts['ncpus']
+
+def _probe_facts(c):
+    # OS, CPUs and NICs in a single round trip
+    facts = gather_facts(c)
+    if facts['ostype'] not in ('Linux', 'FreeBSD'):
+        print('Unsupported OS %s' % facts['ostype'])
+        return {'ostype': None, 'ncpus': None}
+    return facts
+
+def _load_fact_cache():
+    try:
+        with open(FACT_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_fact_cache(cache):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = '{}.{}'.format(FACT_CACHE, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp, FACT_CACHE)
+
+def _boot_id(c):
+    return c.run('cat /proc/sys/kernel/random/boot_id 2>/dev/null'
+                 ' || sysctl -n kern.boottime', hide='both').stdout.strip()
+
+def host_facts(c, refresh=False):
+    # Cached facts are valid for the same boot within FACT_TTL. The boot ID
+    # is checked once per connection, c.boot_id is the one checked.
+    host = c.original_host
+    with _cache_lock:
+        ent = _load_fact_cache().get(host)
+    if (ent and not refresh and 'nics' in ent and
+            time.time() - ent['time'] < FACT_TTL):
+        if 'boot_id' not in c:
+            c.boot_id = _boot_id(c)
+        if ent['boot_id'] == c.boot_id:
+            return ent
+    ent = _probe_facts(c)
+    if ent['ostype'] is None:
+        return ent
+    c.boot_id = ent['boot_id']
+    ent['time'] = time.time()
+    with _cache_lock:
+        cache = _load_fact_cache()
+        cache[host] = ent
+        _save_fact_cache(cache)
+    return ent
+
+def invalidate_facts(c):
+    c.config.pop('boot_id', None)
+    with _cache_lock:
+        cache = _load_fact_cache()
+        if cache.pop(c.original_host, None) is not None:
+            _save_fact_cache(cache)
+
+@task
+def flush_facts(c, host=None):
+    if host:
+        invalidate_facts(Connection(host))
     else:
-        print('Unsupported OS %s' % ostype)
-        return None, None
-    return ostype, ncpus
+        with _cache_lock:
+            _save_fact_cache({})
 
 def _hostenv(c, output=False):
-    c.ostype, c.ncpus = ostype_and_ncores(c)
+    _trace_conn(c)
+    c.facts = host_facts(c)
+    c.ostype, c.ncpus = c.facts['ostype'], c.facts['ncpus']
     hostenv(c)
     c.output = c.original_host + '.log' if output else None
     return c
 
 # Survive broken proxycommand handler of rsync
-def get_ssh_opts(c):
+def _proxy_opts(c):
     if 'proxycommand' in c.ssh_config:
         return '-o "ProxyCommand {}"'.format(c.ssh_config['proxycommand'])
     return ''
 
+#
+# One ssh ControlMaster per host shared by rsync and other ssh invocations
+# until exit, unless nomux is set for the host or FAB_NOMUX in the environment
+#
+MUX_DIR = os.path.join(CACHE_DIR, 'mux')
+_mux_conns = {}
+
+def _ssh_dest(c):
+    return '-p {} {}@{}'.format(c.port, c.user, c.host)
+
+def _mux_path(c):
+    if 'nomux' in c or os.environ.get('FAB_NOMUX'):
+        return None
+    path = os.path.join(MUX_DIR, _hash_key(c.user, c.host, str(c.port)))
+    with _cache_lock:
+        started = path in _mux_conns
+        _mux_conns[path] = c
+    if not started:
+        os.makedirs(MUX_DIR, mode=0o700, exist_ok=True)
+        # stdio off, or the master would hold the pipes of local(), and no
+        # prompts, which would wait on the tty
+        r = c.local('ssh {} -o BatchMode=yes -o ControlMaster=yes'
+                ' -o ControlPath={} -o ControlPersist=yes -fN {}'
+                ' < /dev/null > /dev/null 2>&1'
+                .format(_proxy_opts(c), path, _ssh_dest(c)), warn=True)
+        if not r.ok:
+            print('{}: no ssh ControlMaster'.format(c.original_host))
+    # without the socket, ssh just connects by itself
+    return path
+
+def _mux_teardown():
+    for path, c in _mux_conns.items():
+        if os.path.exists(path):
+            c.local('ssh -o BatchMode=yes -o ControlPath={} -O exit {}'
+                    .format(path, _ssh_dest(c)), warn=True, hide='both')
+
+atexit.register(_mux_teardown)
+
+def get_ssh_opts(c):
+    opts = [_proxy_opts(c)]
+    mux = _mux_path(c)
+    if mux:
+        opts.append('-o ControlMaster=no -o ControlPath={}'.format(mux))
+    return ' '.join(o for o in opts if o)
+
 @task
 def rsynctest(c, host, src, dst):
     c = Connection(host)
@@ -105,32 +432,257 @@ def _exists(c, s):
 @task
 def noht(c, host=None):
     c = ensure_connected(c, host)
-    c.sudo('bash -c "echo off > /sys/devices/system/cpu/smt/control"',warn=True,
-            echo=True)
-    time.sleep(1)
+    smt = '/sys/devices/system/cpu/smt/control'
+    r = c.run('cat {}'.format(smt), warn=True, hide='both')
+    if r.stdout.strip() != 'on':
+        return
+    c.sudo('bash -c "echo off > {}"'.format(smt), warn=True, echo=True)
+    _wait_ready(c, [('smt_off',)], timeout=10, warn=True)
+    # online CPUs have changed
+    invalidate_facts(c)
+
+# (read, write) of each runtime knob, write takes the value as {0}
+_sysfs_cpu = '/sys/devices/system/cpu'
+_tunables = {
+    'governor': ('cat {0}/cpu0/cpufreq/scaling_governor'.format(_sysfs_cpu),
+        'for f in {0}/cpu*/cpufreq/scaling_governor; do echo {{0}} > $f; done'
+        .format(_sysfs_cpu)),
+    # intel_pstate says no_turbo, acpi-cpufreq says boost
+    'turbo': ('f={0}/intel_pstate/no_turbo; if [ -e $f ]; then'
+        ' [ $(cat $f) = 0 ] && echo on || echo off;'
+        ' elif [ -e {0}/cpufreq/boost ]; then'
+        ' [ $(cat {0}/cpufreq/boost) = 1 ] && echo on || echo off; fi'
+        .format(_sysfs_cpu),
+        'f={0}/intel_pstate/no_turbo; v={{0}}; if [ -e $f ]; then'
+        ' [ $v = on ] && echo 0 > $f || echo 1 > $f;'
+        ' else [ $v = on ] && echo 1 > {0}/cpufreq/boost'
+        ' || echo 0 > {0}/cpufreq/boost; fi'.format(_sysfs_cpu)),
+    # deepest idle state left enabled
+    'cstate': ('n=; for s in {0}/cpu0/cpuidle/state*; do'
+        ' [ $(cat $s/disable) = 0 ] && n=${{s##*state}}; done; echo $n'
+        .format(_sysfs_cpu),
+        'for s in {0}/cpu*/cpuidle/state*; do'
+        ' [ ${{{{s##*state}}}} -gt {{0}} ] && echo 1 > $s/disable'
+        ' || echo 0 > $s/disable; done'.format(_sysfs_cpu)),
+    'irqbalance': ('systemctl is-active irqbalance',
+        'systemctl $([ {0} = active ] && echo start || echo stop) irqbalance'),
+    'thp': ('sed "s/.*\\[\\(.*\\)\\].*/\\1/"'
+        ' /sys/kernel/mm/transparent_hugepage/enabled',
+        'echo {0} > /sys/kernel/mm/transparent_hugepage/enabled'),
+}
+TUNING = os.path.join(CACHE_DIR, 'tuning.json')
+
+def _read_tunables(c, names):
+    # Current values in one round trip, '' for what the host doesn't have
+    r = c.run(_sh_script('\n'.join('echo "@@{} $({} 2>/dev/null)"'.format(k,
+        _tunables[k][0]) for k in names)), hide='both', warn=True)
+    vals = {}
+    for l in r.stdout.splitlines():
+        if l.startswith('@@'):
+            k, _, v = l[2:].partition(' ')
+            vals[k] = v.strip()
+    return vals
+
+def _write_tunables(c, vals):
+    _run_script(c, [_tunables[k][1].format(v) for k, v in sorted(vals.items())])
+    now = _read_tunables(c, vals)
+    bad = ['{} {} (wanted {})'.format(k, now.get(k) or '-', v)
+            for k, v in sorted(vals.items()) if now.get(k) != v]
+    if bad:
+        print('tune_host: not applied: {}'.format(', '.join(bad)))
+    return now
+
+def _load_tuning():
+    try:
+        with open(TUNING) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_tuning(tuning):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(TUNING, 'w') as f:
+        json.dump(tuning, f, indent=1, sort_keys=True)
+
+def host_tuning(c):
+    # profile applied in the current boot, if any
+    ent = _load_tuning().get(c.original_host)
+    if ent and ent['boot_id'] == host_facts(c)['boot_id']:
+        return {'profile': ent['profile'], 'values': ent['values']}
+    return None
+
+def _tune_host(c, profile='perf', restore=False):
+    if not is_linux(c):
+        print('tune_host: only Linux is supported')
+        return
+    host = c.original_host
+    boot_id = host_facts(c)['boot_id']
+    with _cache_lock:
+        ent = _load_tuning().get(host)
+    if ent and ent['boot_id'] != boot_id:
+        # rebooted, everything is back to the defaults
+        ent = None
+    if restore:
+        if not ent:
+            print('tune_host: nothing to restore')
+        else:
+            _write_tunables(c, ent['saved'])
+            print('tune_host: restored {}'.format(ent['saved']))
+        with _cache_lock:
+            tuning = _load_tuning()
+            tuning.pop(host, None)
+            _save_tuning(tuning)
+        return
+
+    want = tune_profiles[profile]
+    cur = _read_tunables(c, want)
+    skip = [k for k in want if not cur.get(k)]
+    if skip:
+        print('tune_host: {} not available'.format(', '.join(skip)))
+    want = dict((k, v) for k, v in want.items() if k not in skip)
+    # keep the values before the first profile applied in this boot
+    saved = ent['saved'] if ent else dict((k, cur[k]) for k in want)
+    now = _write_tunables(c, want)
+    print('tune_host: {} {}'.format(profile, ', '.join('{} {}'.format(k,
+        now.get(k)) for k in sorted(want))))
+    with _cache_lock:
+        tuning = _load_tuning()
+        tuning[host] = {'profile': profile, 'boot_id': boot_id,
+                'saved': saved, 'values': now}
+        _save_tuning(tuning)
+
+@task
+def tune_host(c, host, profile='perf', restore=False, par=8):
+    if _is_multi(host):
+        return _fanout(_tune_host, host, par, profile=profile, restore=restore)
+    _tune_host(ensure_connected(c, _host_list(host)[0]), profile, restore)
+
+def _parse_cpulist(s):
+    # 0-3,8,10-11 format of sysfs
+    cpus = []
+    for r in s.strip().split(','):
+        if r:
+            a, _, b = r.partition('-')
+            cpus += range(int(a), int(b or a) + 1)
+    return cpus
+
+def _nic_irqs(c, ifs):
+    # {ifname: [(irq, queue)]} from /proc/interrupts, queue None means no
+    # multiqueue vector naming
+    r = c.run('grep -E "{}" /proc/interrupts'.format('|'.join(ifs)),
+            hide='both', warn=True)
+    irqs = []
+    for l in r.stdout.splitlines():
+        t = l.split()
+        if t and t[0].endswith(':'):
+            irqs.append((t[0].rstrip(':'), t[-1]))
+    res = {}
+    for i in ifs:
+        mq = [(irq, int(n.split('-')[-1])) for irq, n in irqs
+                if re.search(r'\b{}-TxRx-[0-9]+$'.format(re.escape(i)), n)]
+        res[i] = mq or [(irq, None) for irq, n in irqs
+                if re.search(r'\b{}\b'.format(re.escape(i)), n)]
+    return res
+
+def _pin_plan(facts, ifname, nqueues, nthreads=0, colocate=True):
+    # CPUs for the IRQ of each queue and for each application thread, taken
+    # from the physical cores of the NIC's NUMA node, then their SMT
+    # siblings, then the other nodes, away from the housekeeping core (that
+    # of CPU 0). With colocate, thread N runs on the CPU of queue N,
+    # otherwise on CPUs of its own.
+    cpus = facts.get('cpus') or [{'cpu': x, 'core': x, 'socket': 0,
+        'node': 0} for x in range(facts['ncpus'])]
+    node = facts.get('nics', {}).get(ifname, {}).get('node')
+    if node is None or node < 0:
+        node = cpus[0]['node']
+    nodeof = dict((x['cpu'], x['node']) for x in cpus)
+    core = lambda x: (x['socket'], x['core'])
+    hk = [x['cpu'] for x in cpus if core(x) == core(cpus[0])]
+    first = {}
+    for x in cpus:
+        first.setdefault(core(x), x['cpu'])
+    cores = [x['cpu'] for x in sorted(cpus, key=lambda x: (x['node'] != node,
+        first[core(x)] != x['cpu'], x['cpu'])) if x['cpu'] not in hk]
+    cores = cores or hk[:1]
+    sibling = dict((x['cpu'], first[core(x)]) for x in cpus
+            if first[core(x)] != x['cpu'])
+    plan = {'if': ifname, 'node': node, 'housekeeping': hk, 'queues': [],
+            'threads': [], 'warnings': []}
+    nq, nt = int(nqueues), int(nthreads)
+    need = max(nq, nt) if colocate else nq + nt
+    if need > len(cores):
+        plan['warnings'].append('{} queues and {} threads on {} CPUs, sharing'
+                ' CPUs'.format(nq, nt, len(cores)))
+    pick = lambda i: cores[i % len(cores)]
+    plan['queues'] = [pick(i) for i in range(nq)]
+    plan['threads'] = [pick(i if colocate else nq + i) for i in range(nt)]
+    for k in 'queues', 'threads':
+        for i, x in enumerate(plan[k]):
+            if nodeof[x] != node:
+                plan['warnings'].append('{} {} on CPU {} of remote node {}'
+                        .format(k[:-1], i, x, nodeof[x]))
+            elif x in sibling:
+                plan['warnings'].append('{} {} on CPU {}, SMT sibling of CPU'
+                        ' {}'.format(k[:-1], i, x, sibling[x]))
+    return plan
+
+def _print_plan(plan):
+    print('{}: NUMA node {}, housekeeping CPUs {}, queue CPUs {}, thread CPUs'
+          ' {}'.format(plan['if'], plan['node'], plan['housekeeping'],
+              plan['queues'], plan['threads']))
+    for w in plan['warnings']:
+        print('{}: WARNING {}'.format(plan['if'], w))
+
+@task
+def plan_pinning(c, host, ifname=None, queues=None, threads=1,
+        colocate=True):
+    c = ensure_connected(c, host)
+    ifname = ifname or c.ifs[0]
+    if queues is None:
+        q = c.facts['nics'].get(ifname, {}).get('queues', {})
+        queues = q.get('combined') or q.get('rx') or 1
+    _print_plan(_pin_plan(c.facts, ifname, queues, threads, colocate))
+
+def _set_irq_affinity(c, plan):
+    # Write all affinities in one privileged step and read them back
+    cmds = ['echo {} > /proc/irq/{}/smp_affinity_list'.format(cpu, irq)
+            for irq, cpu in plan]
+    cmds.append('for i in {}; do echo "@@irq $i'
+            ' $(cat /proc/irq/$i/smp_affinity_list)"; done'.format(
+                ' '.join(irq for irq, cpu in plan)))
+    res = _run_script(c, cmds, echo=False)
+    cur = dict(l.split()[1:3] for l in res[-1].stdout.splitlines()
+            if l.startswith('@@irq') and len(l.split()) == 3)
+    bad = []
+    for (irq, cpu), r in zip(plan, res):
+        ok = _parse_cpulist(cur.get(irq, '')) == [cpu]
+        print('irq {:>5} -> cpu {:<3} {}'.format(irq, cpu, 'ok' if ok else
+            'FAILED (now {}) {}'.format(cur.get(irq), r.stdout.strip())))
+        if not ok:
+            bad.append(irq)
+    return bad
 
 @task
 def setup_irq(c, host=None):
     c = ensure_connected(c, host)
 
-    nomq = False
+    facts = host_facts(c)
+    nic_irqs = _nic_irqs(c, c.ifs)
+    plan = []
     for i in c.ifs:
-        s = 'cat /proc/interrupts | grep "{}-TxRx" | tr -s " " | sed "s/^ //"'
-        r = c.run(s.format(i), hide='stdout', echo=True, warn=True)
-        print('r.stdout', r.stdout)
-        if not r.stdout:
-            nomq = True
-            r = c.run(s.replace('-TxRx', '').format(i), echo=True, warn=True)
-        if r.failed:
+        irqs = nic_irqs[i]
+        if not irqs:
+            print('{}: no IRQs found'.format(i))
             continue
-        lines = r.stdout.split('\n')[:-1]
-        for l in lines:
-            irq = l.split(':')[0]
-            cor = 0 if nomq else int(l.split('-')[-1])
-            p = '/proc/irq/{}/smp_affinity'.format(irq)
-            c.sudo('bash -c "echo {:x} >> {}"'.format(1 << cor, p), echo=True)
-
-def do_ifcmd(c, cmd, ifname):
+        nq = len([q for irq, q in irqs if q is not None])
+        pp = _pin_plan(facts, i, max(nq, 1))
+        _print_plan(pp)
+        plan += [(irq, pp['queues'][0 if q is None else q % len(pp['queues'])])
+                for irq, q in irqs]
+    if plan and _set_irq_affinity(c, plan):
+        print('Some IRQ affinities could not be set')
+
+def _ifcmd(c, cmd, ifname):
     nrings = c.ncpus
     if 'nrings' in c:
         nrings = c.nrings
@@ -139,9 +691,232 @@ def do_ifcmd(c, cmd, ifname):
         ift = re.split('[0-9]', ifname)[0]
         ifi = ifname[len(ift):len(ifname)]
         n = ('{}.{}'.format(ift, ifi), '{}'.format(nrings))
-    c.sudo(cmd.format(*n), warn=True, echo=True)
+    return cmd.format(*n)
 
-def _setup_ifs(c, host=None, ifs=None, profiles=[]):
+def do_ifcmd(c, cmd, ifname):
+    c.sudo(_ifcmd(c, cmd, ifname), warn=True, echo=True)
+
+def _sh_script(script):
+    # command line that runs script without any quoting issue
+    return 'sh -c "echo {} | base64 -d | sh"'.format(
+            base64.b64encode(script.encode()).decode())
+
+# Conditions _wait_ready polls for
+_ready_tests = {
+    'smt_off': '[ "$(cat /sys/devices/system/cpu/smt/active)" = 0 ]',
+    'module': '[ -d /sys/module/{0} ]',
+    'link': ('[ "$(cat /sys/class/net/{0}/operstate)" = up ]'
+             ' && [ "$(cat /sys/class/net/{0}/carrier)" = 1 ]'),
+    'queues': '[ $(ls -d /sys/class/net/{0}/queues/rx-* | wc -l) -eq {1} ]',
+    'pid': '[ -s {0} ] && [ -d /proc/$(cat {0}) ]',
+}
+
+def _wait_script(waits, timeout=30):
+    # Shell loop polling each wait, e.g., ('link', 'ens1f0') until timeout
+    lines = ['s=$(date +%s%N)']
+    for w in waits:
+        t = _ready_tests[w[0]].format(*w[1:])
+        lines += ['until {{ {} ; }} 2>/dev/null; do'.format(t),
+                  '  [ $(( ($(date +%s%N) - s) / 1000000 )) -ge {} ] && break'
+                  .format(int(timeout * 1000)),
+                  '  sleep 0.05',
+                  'done',
+                  '{{ {} ; }} 2>/dev/null && r=ready || r=timeout'.format(t),
+                  'echo "@@wait {} $r $(( ($(date +%s%N) - s) / 1000000 ))"'
+                  .format(' '.join(str(x) for x in w))]
+    return '\n'.join(lines)
+
+def _wait_report(out, warn=False):
+    # Print the waits in out of _wait_script and check them
+    late = []
+    for l in out.splitlines():
+        t = l.split()
+        if t and t[0] == '@@wait':
+            print('wait {}: {} after {} ms'.format(' '.join(t[1:-2]), t[-2],
+                t[-1]))
+            if t[-2] != 'ready':
+                late.append(' '.join(t[1:-2]))
+    if late and not warn:
+        raise Exception('Not ready: {}'.format(', '.join(late)))
+    return late
+
+def _wait_ready(c, waits, timeout=30, warn=False):
+    if not waits:
+        return []
+    r = c.run(_sh_script(_wait_script(waits, timeout)), hide='both', warn=True)
+    return _wait_report(r.stdout, warn=warn)
+
+def _run_script(c, cmds, sudo=True, warn=True, echo=True):
+    # Run cmds in one remote shell and split the output per command. Returns
+    # a Result for each command that has been run.
+    if not cmds:
+        return []
+    lines = []
+    for n, cmd in enumerate(cmds):
+        lines.append('echo "@@fab-begin {}"'.format(n))
+        lines.append('{{ {}\n}} 2>&1 </dev/null; rc=$?'.format(cmd))
+        # on its own line even if the output doesn't end with a newline
+        lines.append('printf "\\n@@fab-end {} %d\\n" $rc'.format(n))
+        if not warn:
+            lines.append('[ $rc -eq 0 ] || exit $rc')
+    cmd = _sh_script('\n'.join(lines))
+    r = (c.sudo if sudo else c.run)(cmd, warn=True, hide='both')
+
+    results = []
+    out = None
+    for l in r.stdout.splitlines(True):
+        m = re.match('@@fab-(begin|end) ([0-9]+)(?: ([0-9]+))?$', l.strip())
+        if m and m.group(1) == 'begin':
+            out = []
+        elif m and out is not None:
+            # without the newline printed before the end marker
+            out = ''.join(out)
+            if out.endswith('\n'):
+                out = out[:-1]
+            results.append(Result(stdout=out, command=cmds[int(m.group(2))],
+                exited=int(m.group(3))))
+            out = None
+        elif out is not None:
+            out.append(l)
+    for res in results:
+        if echo:
+            print(res.command)
+            if res.stdout:
+                print(res.stdout, end='')
+        if res.exited != 0 and not warn:
+            raise UnexpectedExit(res)
+    if r.exited != 0 and len(results) < len(cmds) and not warn:
+        raise UnexpectedExit(r)
+    return results
+
+# ethtool -K option names as reported by ethtool -k
+_ethtool_features = {
+    'tx': 'tx-checksumming', 'rx': 'rx-checksumming', 'sg': 'scatter-gather',
+    'tso': 'tcp-segmentation-offload', 'ufo': 'udp-fragmentation-offload',
+    'gso': 'generic-segmentation-offload', 'gro': 'generic-receive-offload',
+    'lro': 'large-receive-offload', 'rxvlan': 'rx-vlan-offload',
+    'txvlan': 'tx-vlan-offload', 'ntuple': 'ntuple-filters',
+    'rxhash': 'receive-hashing',
+}
+
+def _parse_ethtool(opt, out):
+    # Returns {name: value} in the option names of ethtool -K/-C/-L/-A
+    st = {}
+    if opt in ('-L', '-G'):
+        # skip pre-set maximums
+        out = out.partition('Current hardware settings:')[2]
+    for l in out.splitlines():
+        k, sep, v = l.partition(':')
+        if not sep or not v.strip():
+            continue
+        k, v = k.strip(), v.split()
+        if opt == '-K':
+            st[k] = (v[0], '[fixed]' in v)
+        elif opt == '-C' and k == 'Adaptive RX':
+            # Adaptive RX: off  TX: off
+            st['adaptive-rx'] = v[0]
+            if len(v) > 2:
+                st['adaptive-tx'] = v[2]
+        elif opt == '-A' and k == 'Autonegotiate':
+            st['autoneg'] = v[0]
+        else:
+            st[k.lower()] = v[0]
+    return st
+
+def _nic_state(c, ifs):
+    # Current ethtool settings and link flags of all ifs in one round trip
+    cmd = ('for i in {}; do echo "@@if $i";'
+           ' for o in k c l a; do echo "@@ -$o"; ethtool -$o $i; done;'
+           ' echo "@@ link"; ip -o link show $i; done 2>/dev/null')
+    r = c.run(cmd.format(' '.join(ifs)), warn=True, hide='both')
+    state = {}
+    for blk in r.stdout.split('@@if ')[1:]:
+        ifname, _, blk = blk.partition('\n')
+        st = state[ifname] = {}
+        for sec in blk.split('@@ ')[1:]:
+            opt, _, out = sec.partition('\n')
+            if opt == 'link':
+                m = re.search('<([^>]*)>', out)
+                st[opt] = m.group(1).split(',') if m else []
+            else:
+                st[opt.upper()] = _parse_ethtool(opt.upper(), out)
+    return state
+
+def _ifcmd_diff(cmd, state):
+    # Reduce cmd to the settings that differ from state, which is updated.
+    # Returns the command to run (None if nothing to do) and the changes.
+    t = cmd.split()
+    if t[:3] == ['ip', 'link', 'set'] and len(t) in (5, 6) and t[3] in state:
+        flags = state[t[3]].get('link')
+        flag = 'UP' if t[4:] == ['up'] else 'PROMISC' if t[4:] == [
+                'promisc', 'on'] else None
+        if flags is None or flag is None:
+            return cmd, []
+        if flag in flags:
+            return None, []
+        flags.append(flag)
+        return cmd, [(flag.lower(), 'off', 'on')]
+    if (len(t) < 5 or t[0] != 'ethtool' or t[1] not in ('-K', '-C', '-L', '-A')
+            or t[2] not in state or len(t) % 2 == 0):
+        return cmd, []
+    st = state[t[2]].get(t[1], {})
+    keep, changes = [], []
+    for k, v in zip(t[3::2], t[4::2]):
+        if t[1] == '-K':
+            cur, fixed = st.get(_ethtool_features.get(k, k), (None, False))
+            if cur is not None and cur != v and fixed:
+                print('{}: {} is fixed to {}'.format(t[2], k, cur))
+                continue
+        else:
+            cur = st.get(k)
+        if cur == v:
+            continue
+        keep += [k, v]
+        changes.append((k, cur, v))
+        if t[1] == '-K':
+            st[_ethtool_features.get(k, k)] = (v, False)
+        else:
+            st[k] = v
+    if not keep:
+        return None, []
+    return ' '.join(t[:3] + keep), changes
+
+def _diff_ifcmds(c, cmds):
+    # Drop the interface settings that are already in place
+    ifs = set()
+    for cmd in cmds:
+        t = cmd.split()
+        if t[0] == 'ethtool' and len(t) > 2:
+            ifs.add(t[2])
+        elif t[:3] == ['ip', 'link', 'set'] and len(t) > 3:
+            ifs.add(t[3])
+    if not ifs or not is_linux(c):
+        return cmds
+    state = _nic_state(c, sorted(ifs))
+    res = []
+    for cmd in cmds:
+        d, changes = _ifcmd_diff(cmd, state)
+        t = cmd.split()
+        for k, old, new in changes:
+            print('{}: {} {} -> {}'.format(t[2] if t[0] == 'ethtool' else t[3],
+                k, old, new))
+        if d:
+            res.append(d)
+    print('{} of {} interface commands needed'.format(len(res), len(cmds)))
+    return res
+
+def do_ifcmds(c, cmds, ifname, force=False):
+    cmds = [_ifcmd(c, cmd, ifname) for cmd in cmds]
+    if not force:
+        cmds = _diff_ifcmds(c, cmds)
+    res = _run_script(c, cmds)
+    # queues and rings in the cached facts are stale now
+    if cmds:
+        invalidate_facts(c)
+    return res
+
+def _setup_ifs(c, host=None, ifs=None, profiles=[], nobatch=False,
+        force=False):
 
     c = ensure_connected(c, host)
     if not ifs:
@@ -152,30 +927,57 @@ def _setup_ifs(c, host=None, ifs=None, profiles=[]):
         print('Ensuring no HT enabled')
         noht(c, host)
     # ncpus may has changed
-    c.ostype, c.ncpus = ostype_and_ncores(c)
+    c.facts = host_facts(c)
+    c.ostype, c.ncpus = c.facts['ostype'], c.facts['ncpus']
+    if is_linux(c):
+        missing = [i for i in ifs if i not in c.facts['nics']]
+        if missing:
+            print('{}: no such interface(s) {}'.format(c.original_host,
+                ', '.join(missing)))
+            ifs = [i for i in ifs if i not in missing]
 
     # configure interfaces
+    cmds = []
     for i in ifs:
         for p in profiles:
             cmdlist = []
             if p in c.nic_all_profiles:
                 cmdlist = c.nic_all_profiles[p]
             for cmd in cmdlist:
-                do_ifcmd(c, cmd, i)
+                cmds.append(_ifcmd(c, cmd, i))
     # set irq properly if possible
     #if is_linux(c):
     #    setup_irq(c, host)
 
+    profcmds = list(cmds)
+    if not force:
+        cmds = _diff_ifcmds(c, cmds)
+
     # configure IP addresses
     for i in ifs:
         if 'ifs_addr' in c and i in c.ifs_addr:
             if is_linux(c):
                 # warn on the address already exists
-                c.sudo('ip addr add {} dev {}'.format(c.ifs_addr[i], i),
-                        warn=True, echo=True)
+                cmds.append('ip addr add {} dev {}'.format(c.ifs_addr[i], i))
             elif is_freebsd(c):
-                c.sudo('ifconfig %s inet %s' % (i, c.ifs_addr[i]), warn=True,
-                        echo=True)
+                cmds.append('ifconfig %s inet %s' % (i, c.ifs_addr[i]))
+
+    if nobatch:
+        for cmd in cmds:
+            c.sudo(cmd, warn=True, echo=True)
+    else:
+        _run_script(c, cmds)
+
+    # links and queues may take a while after ethtool resets the NIC
+    if is_linux(c):
+        waits = [('link', i) for i in ifs]
+        for cmd in profcmds:
+            m = re.match('ethtool -L (\S+) combined ([0-9]+)$', cmd)
+            if m:
+                waits.append(('queues', m.group(1), m.group(2)))
+        _wait_ready(c, waits, warn=True)
+    if cmds:
+        c.facts = host_facts(c, refresh=True)
 
 def _netmap_debug(c, en):
     f = os.path.join(c.netmap_src, 'sys/dev/netmap/netmap_kern.h')
@@ -191,33 +993,98 @@ def _netmap_debug(c, en):
         else:
             c.run("sed -zi '1s/{}\n//' {}".format(s, f))
 
+def _module_graph(c):
+    # {module: modules holding it} from /proc/modules and /sys/module/*/holders
+    r = c.run('cat /proc/modules; echo @@; cd /sys/module && for m in'
+              ' */holders; do echo "${m%/holders}" $(ls $m); done', warn=True,
+              hide='both')
+    mods, _, holders = r.stdout.partition('@@\n')
+    graph = {}
+    for l in mods.splitlines():
+        t = l.split()
+        graph[t[0]] = set(x for x in t[3].split(',') if x not in ('', '-'))
+    for l in holders.splitlines():
+        t = l.split()
+        if t and t[0] in graph:
+            graph[t[0]].update(t[1:])
+    return graph
+
+def _unload_order(graph, mods):
+    # Loaded modules in mods and all their holders, holders first
+    order = []
+    visiting = set()
+    def visit(m):
+        if m in order or m in visiting or m not in graph:
+            return
+        visiting.add(m)
+        for h in sorted(graph[m]):
+            visit(h)
+        order.append(m)
+    for m in mods:
+        visit(m)
+    return order
+
+def _rmmod_cmds(order):
+    return ['rmmod {0} || modprobe -r {0}'.format(m) for m in order]
+
 @task
-def unload_netmap(c):
-    r = c.run('lsmod', hide='both').stdout
-    lines = r.split('\n')
+def unload_netmap(c, host=None):
+    c = ensure_connected(c, host)
+    graph = _module_graph(c)
 
     # TODO: delete all vale instances and their lookup modules
 
-    netmap_modules = []
-    for l in lines:
-        items = l.split()
-        if items and items[0] == 'netmap':
-            if len(items) == 4: # has modules relying on netmap
-                netmap_modules += items[3].split(',')
-            break
-    else:
+    if 'netmap' not in graph:
         print('netmap is not loaded')
         return
-    print('unload_netmap: netmap_modules ', netmap_modules)
+    order = _unload_order(graph, ['netmap'])
+    print('unload_netmap: ', order)
+    _run_script(c, _rmmod_cmds(order))
+    left = [m for m in order if m in _module_graph(c)]
+    if left:
+        print('unload_netmap: could not unload', left)
+
+def _netmap_sizing(c, ifs=None):
+    # Queue counts, ring sizes, NUMA nodes and free memory in one round trip
+    ifs = ifs or c.ifs
+    cmd = ('for i in {}; do echo "@@if $i'
+           ' $(cat /sys/class/net/$i/device/numa_node 2>/dev/null || echo -1)";'
+           ' echo "@@ -L"; ethtool -l $i; echo "@@ -G"; ethtool -g $i;'
+           ' done 2>/dev/null; echo "@@mem";'
+           ' cat /sys/devices/system/node/node*/meminfo 2>/dev/null | grep MemFree'
+           ' || grep MemFree /proc/meminfo')
+    r = c.run(cmd.format(' '.join(ifs)), hide='both', warn=True)
+    out, _, mem = r.stdout.partition('@@mem\n')
+    nics = {}
+    for blk in out.split('@@if ')[1:]:
+        hdr, _, blk = blk.partition('\n')
+        st = {}
+        for sec in blk.split('@@ ')[1:]:
+            opt, _, o = sec.partition('\n')
+            st[opt] = _parse_ethtool(opt, o)
+        num = lambda d, k: int(d[k]) if d.get(k, '').isdigit() else 0
+        ch, rg = st.get('-L', {}), st.get('-G', {})
+        nics[hdr.split()[0]] = {'node': int(hdr.split()[1]),
+                'rxq': num(ch, 'combined') + num(ch, 'rx') or 1,
+                'txq': num(ch, 'combined') + num(ch, 'tx') or 1,
+                'slots': max(num(rg, 'rx'), num(rg, 'tx'))}
+    memfree = {}
+    for l in mem.splitlines():
+        t = l.split()
+        # Node 0 MemFree: 1234 kB, or MemFree: 1234 kB
+        memfree[int(t[1]) if t[0] == 'Node' else -1] = int(t[-2]) * 1024
+    return netmap_priv_sizing(c.ncpus, nics, memfree)
 
-    for m in netmap_modules:
-        if m == 'i40e':
-            c.sudo('rmmod i40iw', warn=True)
-        c.sudo('rmmod ' + m, warn=True)
-        r = c.sudo('modprobe -r ' + m, warn=True)
-        if r.exited != 0:
-            r = c.sudo('rmmod ' + m)
-    c.sudo('rmmod netmap', warn=True)
+@task
+def netmap_sizing(c, host):
+    c = ensure_connected(c, host)
+    sizing, why = _netmap_sizing(c)
+    print('\n'.join(why))
+
+def _nm_module(m):
+    if re.search('\.c', m):
+        m = m.strip('\.c')
+    return m
 
 def _load_netmap(c, host=None, debug=False):
     c = ensure_connected(c, host)
@@ -236,106 +1103,249 @@ def _load_netmap(c, host=None, debug=False):
         c.sudo('sysctl -w dev.netmap.verbose={}'.format(verbose))
         c.sudo('sysctl -w dev.netmap.debug={}'.format(debug), warn=True)
         return
-    unload_netmap(c)
 
-    c.sudo('insmod ' + '{}/netmap.ko'.format(c.netmap_src), echo=True)
-    c.sudo('lsmod')
+    # Unload netmap, the in-kernel drivers and whatever holds them, in
+    # dependency order, then load ours, all in one privileged step
+    mods = [_nm_module(m) for m in c.nm_modules]
+    order = _unload_order(_module_graph(c), ['netmap'] + mods)
+    print('load_netmap: unloading', order)
+    cmds = _rmmod_cmds(order)
+    cmds.append('insmod ' + '{}/netmap.ko'.format(c.netmap_src))
+    nload = len(cmds)
     if 'nm_premod' in c:
         for m in c.nm_premod:
-            c.sudo('modprobe ' + m)
-    time.sleep(1)
-    for m in c.nm_modules:
-        if re.search('\.c', m):
-            m = m.strip('\.c')
-
-        # remove depending modules
-        lsmod = c.run('lsmod | grep ^' + m, warn=True, hide='both')
-        res = re.split('\s+', lsmod.stdout)[:-1]
-        if len(res) > 3:
-            dep_modules = res[-1].split(',')
-            for dep in dep_modules:
-                c.sudo('rmmod ' + dep, warn=True)
-
-        if lsmod.exited == 0:
-            c.sudo('rmmod ' + m, warn=True) # XXX e1000e against e1000
-            #sudo('modprobe -r ' + m, warn_only=True) # XXX e1000e against e1000
-            c.sudo('lsmod')
-        for k in '%s/%s.ko'%(m,m), '%s.ko'%m:
-            k = os.path.join(c.netmap_src, k)
-            if _exists(c, k):
-                r = c.sudo('insmod ' + k, warn=True, echo=True)
-                if r.exited != 0:
-                    r = c.sudo('modprobe ' + k)
-                break
+            cmds.append('modprobe ' + m)
+    cmds.append(_wait_script([('module', m) for m in ['netmap'] +
+        (c.nm_premod if 'nm_premod' in c else [])], timeout=10))
+    for m in mods:
+        k = [os.path.join(c.netmap_src, k) for k in ('%s/%s.ko'%(m,m),
+            '%s.ko'%m)]
+        cmds.append('k={}; [ -e $k ] || k={}; [ -e $k ] && insmod $k'
+                ' || {{ echo "Couldn\'t load {}.ko"; false; }}'.format(k[0], k[1], m))
+    res = _run_script(c, cmds, echo=False)
+    for r in res:
+        if '@@wait' in r.stdout:
+            _wait_report(r.stdout, warn=True)
         else:
-            raise Exception('Couldn\'t find %s.ko!'%m)
-#        for v, k in ((32, 'if_num'), (64, 'ring_num'), (32784, 'buf_num'), (36864, 'ring_size')):
+            print(r.command)
+            print(r.stdout, end='')
+    if res[nload - 1].exited != 0:
+        raise UnexpectedExit(res[nload - 1])
+    if debug:
+        # debug only exists in netmap built with CONFIG_NETMAP_DEBUG
+        _run_script(c, ['echo 16384 > /sys/module/netmap/parameters/verbose',
+                        'echo 65536 > /sys/module/netmap/parameters/debug'
+                        ' || echo "not a netmap debug build"',
+                        'echo 7 > /proc/sys/kernel/printk'], warn=False)
+
+    # netmap drivers hold netmap
+    graph = _module_graph(c)
+    bad = [m for m in mods if m not in graph.get('netmap', ())]
+    print('load_netmap: netmap {}, drivers {}'.format('netmap' in graph,
+        ', '.join('{} {}'.format(m, 'ok' if m not in bad else
+            'loaded without netmap' if m in graph else 'missing')
+            for m in mods)))
+    if bad:
+        raise Exception('Couldn\'t load netmap drivers {}'.format(bad))
 
     # setup queue first
     for i in c.ifs:
+        cmds = []
         for p in c.nic_profiles:
             cmdlist = []
             if p in c.nic_all_profiles:
                 cmdlist = c.nic_all_profiles[p]
             for cmd in cmdlist:
                 if 'ethtool -L' in cmd:
-                    do_ifcmd(c, cmd, i)
-
-    for v, k in ((c.priv_if_num, 'if_num'), (c.priv_ring_num, 'ring_num'),
-            (c.priv_buf_num, 'buf_num'), (c.priv_ring_size, 'ring_size')):
-        c.sudo('bash -c "echo %d >> /sys/module/netmap/parameters/priv_%s"'%(v,
-            k), echo=True)
-    if debug:
-        c.sudo('bash -c "echo 16384 >> /sys/module/netmap/parameters/verbose"',
-            echo=True)
-        c.sudo('bash -c "echo 65536 >> /sys/module/netmap/parameters/debug"',
-            echo=True, warn=True)
-        c.sudo('bash -c "echo 7 >> /proc/sys/kernel/printk"')
+                    cmds.append(cmd)
+        do_ifcmds(c, cmds, i)
+
+    # size the private allocator for the queues just set up
+    if 'nosizing' not in c:
+        sizing, why = _netmap_sizing(c)
+        print('\n'.join(why))
+        for k, v in sizing.items():
+            c[k] = v
+    _run_script(c, ['echo %d > /sys/module/netmap/parameters/priv_%s'%(v, k)
+        for v, k in ((c.priv_if_num, 'if_num'), (c.priv_ring_num, 'ring_num'),
+            (c.priv_buf_num, 'buf_num'), (c.priv_ring_size, 'ring_size'))],
+        warn=False)
     #sudo('echo %d > /sys/module/netmap/parameters/debug'%65536)
     _setup_ifs(c, c.ifs, profiles=c.nic_profiles)
     print('done load_netmap')
 
 @task
-def load_netmap(c, host, debug=False):
-    _load_netmap(c, host=host, debug=debug)
+def load_netmap(c, host, debug=False, par=8):
+    if _is_multi(host):
+        return _fanout(_load_netmap, host, par, debug=debug)
+    _load_netmap(c, host=_host_list(host)[0], debug=debug)
 
 @task
-def setup_ifs(c, host, ifs=None, profiles=[]):
-    _setup_ifs(c, host, ifs=ifs, profiles=profiles)
+def setup_ifs(c, host, ifs=None, profiles=[], nobatch=False, force=False,
+        par=8):
+    # ifs is comma-separated on the command line
+    kwargs = dict(ifs=ifs.split(',') if ifs else None, profiles=profiles,
+            nobatch=nobatch, force=force)
+    if _is_multi(host):
+        return _fanout(_setup_ifs, host, par, **kwargs)
+    _setup_ifs(c, _host_list(host)[0], **kwargs)
+
+@contextmanager
+def _ccache(c, enable):
+    # Build through the ccache compiler wrappers with a per-host cache
+    if not enable:
+        yield
+        return
+    env = 'CCACHE_DIR={}'.format(c.ccache_dir)
+    r = c.run('{0} ccache -M {1} >/dev/null && {0} ccache -z >/dev/null &&'
+              ' ls -d /usr/lib/ccache /usr/lib64/ccache /usr/local/libexec/ccache'
+              ' 2>/dev/null | head -1'.format(env, c.ccache_size), hide='both')
+    wrapdir = r.stdout.strip()
+    if not wrapdir:
+        raise Exception('No ccache compiler wrappers on {}'.format(
+            c.original_host))
+    t = time.time()
+    with c.prefix('export {} PATH={}:$PATH'.format(env, wrapdir)):
+        yield
+    t = time.time() - t
+    r = c.run('{} ccache --print-stats'.format(env), hide='both', warn=True)
+    if r.failed:
+        c.run('{} ccache -s'.format(env), warn=True)
+        print('build took {:.0f}s'.format(t))
+        return
+    st = dict(l.split('\t')[:2] for l in r.stdout.splitlines() if '\t' in l)
+    hits = sum(int(st.get(k, 0)) for k in ('direct_cache_hit',
+        'preprocessed_cache_hit'))
+    misses = int(st.get('cache_miss', 0))
+    print('ccache: {} hits, {} misses ({:.0f}% hit rate), build took {:.0f}s'
+            .format(hits, misses, 100.0 * hits / max(hits + misses, 1), t))
+
+BUILD_TIMES = os.path.join(CACHE_DIR, 'buildtimes.jsonl')
+MAKE_JOB_MEM = 256 * 1024 # KB of available memory per job
+
+def _make_jobs(c, makecmd='make'):
+    # -j for the current online CPUs and available memory, and -l to hold
+    # back new jobs while the host is loaded, which only GNU make has
+    if is_freebsd(c):
+        # free and inactive pages, the latter being reclaimed on demand
+        cmd = ('sysctl -n hw.ncpu; echo $(( ($(sysctl -n vm.stats.vm.v_free_count)'
+               ' + $(sysctl -n vm.stats.vm.v_inactive_count))'
+               ' * $(sysctl -n hw.pagesize) / 1024 ))')
+    else:
+        cmd = ('getconf _NPROCESSORS_ONLN;'
+               ' grep MemAvailable /proc/meminfo | tr -s " " | cut -d" " -f2')
+    r = c.run(cmd, hide='both').stdout.split('\n')
+    ncpus, mem = int(r[0]), int(r[1])
+    jobs = max(1, min(ncpus + 1, mem // MAKE_JOB_MEM))
+    if is_freebsd(c) and makecmd != 'gmake':
+        return '-j{}'.format(jobs)
+    return '-j{} -l{}'.format(jobs, ncpus)
+
+def _make(c, args='', label=None, makecmd='make', **kwargs):
+    # make with the planned job count, recording how long it took
+    jobs = _make_jobs(c, makecmd)
+    t = time.time()
+    r = c.run(' '.join(x for x in (makecmd, jobs, args) if x), **kwargs)
+    t = time.time() - t
+    label = label or args or makecmd
+    print('{}: {:.1f}s with {}'.format(label, t, jobs))
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with _cache_lock, open(BUILD_TIMES, 'a') as f:
+        f.write(json.dumps({'time': time.time(), 'host': c.original_host,
+            'target': label, 'jobs': jobs, 'seconds': round(t, 1),
+            'exited': r.exited}) + '\n')
+    return r
+
+BUILD_INFO = os.path.join(CACHE_DIR, 'buildinfo.json')
+
+def _load_build_info():
+    try:
+        with open(BUILD_INFO) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_build_info(info):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = '{}.{}'.format(BUILD_INFO, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(info, f, indent=1, sort_keys=True)
+    os.replace(tmp, BUILD_INFO)
+
+def _record_build(c, what, src, path, conffile):
+    # git revision of the local tree uploaded (or of the remote one) and
+    # the config hash of what has just been built on c
+    rev = 'git -C {} describe --always --dirty --abbrev=12'
+    if src:
+        r = c.local(rev.format(src), hide='both', warn=True)
+    else:
+        r = c.run(rev.format(path), hide='both', warn=True)
+    conf = c.run('cd {} && sha1sum < {} | cut -d" " -f1'.format(path,
+        conffile), hide='both', warn=True)
+    with _cache_lock:
+        info = _load_build_info()
+        info.setdefault(c.original_host, {})[what] = {
+                'rev': r.stdout.strip() if r.ok else None,
+                'config': conf.stdout.strip()[:12] if conf.ok else None,
+                'time': time.time()}
+        _save_build_info(info)
+
+def _copy_build(builder, hosts, what):
+    # hosts installed the artifacts built on builder
+    with _cache_lock:
+        info = _load_build_info()
+        for h in hosts:
+            info.setdefault(h, {})[what] = info.get(builder, {}).get(what)
+        _save_build_info(info)
 
-def _make_netmap_linux(c, path, config, apps=False, drivupload=False, load=False, debug=False):
+@task
+def build_times(c, host=None, target=None, n=10):
+    try:
+        with open(BUILD_TIMES) as f:
+            recs = [json.loads(l) for l in f]
+    except OSError:
+        recs = []
+    recs = [r for r in recs if (not host or r['host'] == host) and
+            (not target or r['target'] == target)]
+    for r in recs[-int(n):]:
+        print('{} {:<8} {:<20} {:>8.1f}s  {}{}'.format(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(r['time'])),
+            r['host'], r['target'], r['seconds'], r['jobs'],
+            '' if r['exited'] == 0 else '  (failed)'))
+
+def _netmap_configure_cmd(c, config, apps=False):
     # let's get kernel source path
     if not c.linux_src:
         v = c.run('uname -r', hide=True).stdout.split('-')[0]
         c.linux_src = '/usr/src/linux-source-' + v + '/linux-source-' + v
         print('guess Linux source is at ', c.linux_src)
+    cmd = ('./configure --disable-ptnetmap --disable-generic'
+          ' --enable-extmem --enable-paste')
+          #' --disable-vale --enable-extmem')
+    if apps:
+        cmd += ' --apps={}'.format(apps)
+    else:
+        cmd += ' --no-apps'
+    if 'nm_driver_suffix' in c:
+        cmd += ' --driver-suffix=-netmap'
+    if c.linux_src:
+        cmd += ' --kernel-dir={}'.format(c.linux_src)
+    if config == 'nodriv':
+        cmd += ' --no-drivers'
+    else:
+        cmd += ' --drivers=' + ','.join(c.nm_modules)
+    if 'nm_no_ext_drivers' in c:
+        cmd += ' --no-ext-drivers=' + ','.join(c.nm_no_ext_drivers)
+    return cmd
+
+def _configure_netmap_linux(c, path, config, apps=False, drivupload=False):
+    cmd = _netmap_configure_cmd(c, config, apps)
     with c.cd(path):
-        if not not config:
-            if drivupload:
-                put('i*.tar.gz', 'LINUX/ext-drivers/')
-            cmd = ('./configure --disable-ptnetmap --disable-generic'
-                  ' --enable-extmem --enable-paste')
-                  #' --disable-vale --enable-extmem')
-            if apps:
-                cmd += ' --apps={}'.format(apps)
-            else:
-                cmd += ' --no-apps'
-            if 'nm_driver_suffix' in c:
-                cmd += ' --driver-suffix=-netmap'
-            if c.linux_src:
-                cmd += ' --kernel-dir={}'.format(c.linux_src)
-            if config == 'nodriv':
-                cmd += ' --no-drivers'
-            else:
-                cmd += ' --drivers=' + ','.join(c.nm_modules)
-            if 'nm_no_ext_drivers' in c:
-                cmd += ' --no-ext-drivers=' + ','.join(c.nm_no_ext_drivers)
-            #c.run(cmd) # XXX
-            #c.run('make distclean', hide='both')
-            print(cmd)
-            c.run(cmd)
-        #run('make -j%d KSRC=%s' % (env.ncpus+1, env.linux_src))
-        cmd = 'make'
+        if drivupload:
+            put('i*.tar.gz', 'LINUX/ext-drivers/')
+        #c.run(cmd) # XXX
+        #c.run('make distclean', hide='both')
+        print(cmd)
         c.run(cmd)
 
 @task
@@ -346,7 +1356,6 @@ def _make_netmap_apps(c, host=None, src=None, lib=False):
     c = ensure_connected(c, host)
     makecmd = 'gmake' if is_freebsd(c) else 'make'
     appdir = os.path.join(c.netmap_src, 'apps')
-    cmd = '{} apps'.format(makecmd)
     cleancmd = '{} clean-apps'.format(makecmd)
     if src:
         rsync_upload(c, os.path.join(src, os.path.basename(appdir)), appdir,
@@ -354,11 +1363,11 @@ def _make_netmap_apps(c, host=None, src=None, lib=False):
     if is_linux(c):  
         with c.cd(c.netmap_src):
     #    c.run(cleancmd, warn=True, echo=True)
-            c.run(cmd, warn=True, echo=True)
+            _make(c, 'apps', 'netmap apps', makecmd, warn=True, echo=True)
     if lib:
         with c.cd(os.path.join(c.netmap_src, 'libnetmap')):
             c.run('{} clean'.format(makecmd))
-            c.run(makecmd)
+            _make(c, label='libnetmap', makecmd=makecmd)
     return
     phttpd = os.path.join(appdir, 'phttpd')
     print('phttpd', phttpd, _exists(c, phttpd))
@@ -371,42 +1380,194 @@ def make_homa(c, host, src):
     dst = Path(c.workdir)/Path(src.split('/')[-1])
     rsync_upload(c, src, dst, nogit=c.nogit, delete=True)
     with c.cd(dst):
-        c.run('make')
+        _make(c, label='homa')
+
+def _manifest(src, files):
+    m = {}
+    for f in files:
+        with open(os.path.join(src, f), 'rb') as fp:
+            m[f] = hashlib.md5(fp.read()).hexdigest()
+    return m
+
+def _sync_files(c, src, dst, files):
+    # Send only files whose content differs, in one archive. Unchanged files
+    # keep their mtime, and changed ones get the current time for make.
+    local = _manifest(src, files)
+    with c.cd(dst):
+        r = c.run('md5sum {} 2>/dev/null'.format(' '.join(files)), warn=True,
+                hide='both')
+    remote = {}
+    for l in r.stdout.splitlines():
+        h, _, f = l.partition('  ')
+        remote[f] = h
+    changed = [f for f in files if remote.get(f) != local[f]]
+    print('{} of {} files changed'.format(len(changed), len(files)))
+    if not changed:
+        return changed
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for f in changed:
+            print(os.path.join(src, f), os.path.join(dst, f))
+            tar.add(os.path.join(src, f), arcname=f)
+    buf.seek(0)
+    tmp = os.path.join(dst, '.fab-sync.tar.gz')
+    c.put(buf, tmp)
+    c.run('tar -C {0} -xmzf {1} && rm {1}'.format(dst, tmp))
+    return changed
+
+def _tree_hash(src):
+    # content of all files under src but .git
+    h = hashlib.sha1()
+    for d, dirs, fs in os.walk(src):
+        dirs[:] = sorted(x for x in dirs if x != '.git')
+        for f in sorted(fs):
+            p = os.path.join(d, f)
+            if os.path.isfile(p):
+                h.update(os.path.relpath(p, src).encode())
+                with open(p, 'rb') as fp:
+                    h.update(hashlib.sha1(fp.read()).digest())
+    return h.hexdigest()
+
+def _netmap_update_files(src):
+    # files uploaded when the tree is already configured
+    update_files = []
+    for p in ['sys/dev/netmap', 'sys/net']:
+        for l in sorted(os.listdir(os.path.join(src, p))):
+            if os.path.isfile(os.path.join(src, p, l)):
+                update_files.append(os.path.join(p, l))
+    for f in ['bsd_glue.h', 'netmap_linux.c']:
+        update_files.append(os.path.join('LINUX', f))
+    return update_files
+
+def _upload_netmap(c, src, config):
+    if is_linux(c) and not config:
+        _sync_files(c, src, c.netmap_src, _netmap_update_files(src))
+    else:
+        rsync_upload(c, src, c.netmap_src, nogit=c.nogit, delete=config)
+
+def _upload_hash(c, src, config):
+    # content of what _upload_netmap sends
+    if is_linux(c) and not config:
+        return _hash_key(json.dumps(_manifest(src, _netmap_update_files(src)),
+            sort_keys=True))
+    return _tree_hash(src)
+
+# netmap sources that the make, libnetmap and apps stages build
+_netmap_make_srcs = ('sys/dev/netmap/*.[ch] sys/net/*.h LINUX/*.h'
+        ' LINUX/netmap_linux.c libnetmap/*.[ch] apps/*/*.[ch]')
+
+def _remote_src_hash(c):
+    r = c.run('cd {} && md5sum {} 2>/dev/null | sha1sum'.format(c.netmap_src,
+        _netmap_make_srcs), warn=True, hide='both')
+    return r.stdout.split()[0] if r.stdout else ''
+
+def _configure_hash(c, src):
+    # configure script about to be run, the local one if it gets uploaded
+    if src:
+        with open(os.path.join(src, 'configure'), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    r = c.run('cd {} && sha1sum configure'.format(c.netmap_src), warn=True,
+            hide='both')
+    return r.stdout.split()[0] if r.ok and r.stdout else ''
+
+def _run_stages(c, stages, stampdir, resume=False):
+    # stages are (name, key, function, memoized). A stage records its key in
+    # stampdir when it succeeds. Memoized stages are skipped when the key is
+    # unchanged, and with resume so are all stages before the first change.
+    # A key may be a function of the keys so far, called when the stage is
+    # reached so that it can look at what earlier stages left on the host.
+    def read_stamps():
+        r = c.run('cd {} 2>/dev/null && grep -H . *'.format(stampdir),
+                warn=True, hide='both')
+        return dict(l.split(':', 1) for l in r.stdout.splitlines() if ':' in l)
+    stamps = read_stamps()
+    skip = resume
+    keys = {}
+    for name, key, fn, memo in stages:
+        if callable(key):
+            key = key(keys)
+        keys[name] = key
+        if stamps.get(name) == key and (skip or memo):
+            print('stage {}: up to date'.format(name))
+            continue
+        skip = False
+        t = time.time()
+        fn()
+        # the stage may have removed stamps, e.g., upload with --delete
+        stamps = read_stamps()
+        c.run('mkdir -p {0} && echo {1} > {0}/{2}'.format(stampdir, key, name),
+                hide='both')
+        print('stage {}: done in {:.1f}s'.format(name, time.time() - t))
 
 @task
 def make_netmap(c, host, src=None, config=False,
-        drivupload=False, debug=False, noload=False, apps='pkt-gen,vale-ctl'):
+        drivupload=False, debug=False, noload=False, apps='pkt-gen,vale-ctl',
+        ccache=False, resume=False, par=8):
+    kwargs = dict(src=src, config=config, drivupload=drivupload, debug=debug,
+            noload=noload, apps=apps, ccache=ccache, resume=resume)
+    if _is_multi(host):
+        return _fanout(_make_netmap, host, par, **kwargs)
+    _make_netmap(c, _host_list(host)[0], **kwargs)
+
+def _make_netmap(c, host=None, src=None, config=False,
+        drivupload=False, debug=False, noload=False, apps='pkt-gen,vale-ctl',
+        ccache=False, resume=False):
     c = ensure_connected(c, host)
 
-    if src:
-        if is_linux(c) and not config:
-            update_files = []
-            for p in ['sys/dev/netmap', 'sys/net']:
-                r = c.local('ls {}'.format(os.path.join(src, p)), hide='out')
-                for l in r.stdout.splitlines():
-                    update_files.append(os.path.join(p, l))
-            for f in ['bsd_glue.h', 'netmap_linux.c']:
-                update_files.append(os.path.join('LINUX', f))
-            for f in update_files:
-                print(os.path.join(src, f), os.path.join(c.netmap_src, f))
-                c.put(os.path.join(src, f), os.path.join(c.netmap_src, f))
-        else:
-            rsync_upload(c, src, c.netmap_src, nogit=c.nogit, delete=config)
     #tweak_netmap(env.netmap_src)
     libnetmappath = os.path.join(c.netmap_src, 'libnetmap')
     if is_linux(c):
-        _netmap_debug(c, debug)
-        _make_netmap_linux(c, c.netmap_src, config, apps, drivupload)
-        if _exists(c, libnetmappath):
-            with c.cd(libnetmappath):
-                #run('gcc -c nmreq.c -I../sys -DLIB')
-                #run('ar rcs libnetmap.a nmreq.o')
-                c.run('make')
-        _make_netmap_apps(c, src=src)
+        def make():
+            with _ccache(c, ccache), c.cd(c.netmap_src):
+                _make(c, label='netmap')
+            _record_build(c, 'netmap', src, c.netmap_src, 'config.status')
+
+        def libnetmap():
+            if _exists(c, libnetmappath):
+                with _ccache(c, ccache), c.cd(libnetmappath):
+                    #run('gcc -c nmreq.c -I../sys -DLIB')
+                    #run('ar rcs libnetmap.a nmreq.o')
+                    _make(c, label='libnetmap')
+
+        def netmap_apps():
+            with _ccache(c, ccache):
+                _make_netmap_apps(c, src=src)
+
+        # each stage is keyed by its inputs and those of the stages it uses
+        kup = _hash_key('upload', _upload_hash(c, src, config) if src else '',
+                str(config))
+        kdbg = _hash_key('debug', str(debug))
+        kconf = _hash_key('configure', _netmap_configure_cmd(c, config, apps)
+                if config else '', _configure_hash(c, src) if config else '')
+        # make and later stages follow the sources on the host, whether
+        # uploaded now or changed there
+        kmake = lambda k: _hash_key('make', _remote_src_hash(c), kdbg, kconf)
+        kapps = lambda k: _hash_key('apps', k['make'], str(apps))
+        stages = []
+        if src:
+            stages.append(('upload', kup,
+                lambda: _upload_netmap(c, src, config), False))
+        stages.append(('debug', kdbg, lambda: _netmap_debug(c, debug), False))
+        if config:
+            # memoized, skipped whenever its arguments are unchanged
+            stages.append(('configure', kconf, lambda: _configure_netmap_linux(c,
+                c.netmap_src, config, apps, drivupload), True))
+        stages += [('make', kmake, make, False),
+                ('libnetmap', lambda k: _hash_key('libnetmap', k['make']),
+                    libnetmap, False),
+                ('apps', kapps, netmap_apps, False)]
         if not noload:
-            _load_netmap(c, debug=debug)
+            boot_id = host_facts(c)['boot_id']
+            kload = lambda k: _hash_key('load', k['apps'], str(debug), boot_id)
+            stages.append(('load', kload, lambda: _load_netmap(c, debug=debug),
+                False))
+        # outside netmap_src, which upload with --delete would clean
+        stampdir = os.path.join(c.workdir, '.fab-stamps', 'netmap')
+        _run_stages(c, stages, stampdir, resume=resume)
 
     elif is_freebsd(c):
+        if src:
+            _upload_netmap(c, src, config)
         with c.cd(c.netmap_src):
             print('copying files')
             _netmap_debug(c, debug)
@@ -417,62 +1578,299 @@ def make_netmap(c, host, src=None, config=False,
         with c.cd(c.netmap_src):
             if _exists(c, libnetmappath):
                 with c.cd(libnetmappath):
-                    c.run('gmake')
+                    _make(c, label='libnetmap', makecmd='gmake')
         _make_netmap_apps(c, host=host)
     print('done make_netmap')
 
 @task
 def make_linux(c, host, src=None, config=False,
-        old=True, debug=False, trace=False, opt=False, pmem=False, nospace=False):
-    c = Connection(host)
+        old=True, debug=False, trace=False, opt=False, pmem=False, nospace=False,
+        kdiff=False, ccache=False, par=8):
+    kwargs = dict(src=src, config=config, old=old, debug=debug, trace=trace,
+            opt=opt, pmem=pmem, nospace=nospace, kdiff=kdiff, ccache=ccache)
+    if _is_multi(host):
+        return _fanout(_make_linux, host, par, **kwargs)
+    c = Connection(_host_list(host)[0])
     _hostenv(c)
+    _make_linux(c, **kwargs)
+
+def _make_linux(c, src=None, config=False,
+        old=True, debug=False, trace=False, opt=False, pmem=False, nospace=False,
+        kdiff=False, ccache=False):
     if src:
         rsync_upload(c, src, c.linux_src, nogit=c.nogit, delete=(not not config))
     if config:
         #with c.cd(c.linux_src):
         #    c.run("make mrproper")
-        config_linux(c, old, debug, trace, opt, (not ('nopmem' in c)), nozstd=c.nozstd)
-    with c.cd(c.linux_src):
-        c.run("make -j%d bzImage" % (c.ncpus+1))
-        c.run("make -j%d modules" % (c.ncpus+1))
+        config_linux(c, old, debug, trace, opt, (not ('nopmem' in c)),
+                nozstd=c.nozstd, showdiff=kdiff)
+    with c.cd(c.linux_src), _ccache(c, ccache):
+        _make(c, 'bzImage', 'linux bzImage')
+        _make(c, 'modules', 'linux modules')
         if nospace:
             print('freeing up some space')
             l = c.run('find . | grep "\.o$"').stdout.split('\n')
             batches = [l[i:i+20] for i in range(0, len(l), 20)]
             for b in batches:
                 c.run('rm {}'.format(' '.join(b)), echo=True)
+    _record_build(c, 'linux', src, c.linux_src, '.config')
     print('installing the new kernel to {}'.format(c.linux_src))
     c.sudo('bash -c "cd {} && make INSTALL_MOD_STRIP=1 modules_install"'.format(c.linux_src))
     c.sudo('bash -c "cd {} && make install"'.format(c.linux_src))
 
-def update_kconfig(c, d, conffile):
-    for k, v in d.items():
-        kk = 'CONFIG_' + k
-        # match against uncommented and commented lines
-        for confline in kk + '=', '# ' + kk + ' ':
-            if open(conffile).read().find(confline) != -1:
-                if v == 'n':
-                    if confline[0] != '#':
-                        c.local('sed -i -e "s/{}/{}/" {}'.format(
-                            confline + '.*$', '# ' + kk + ' is not set',
-                            conffile))
-                    # otherwise already commented out
-                else:
-                    if '"' in v:
-                        v = v.replace('"', '\\"')
-                    c.local('sed -i -e "s/{}/{}/" {}'.format( confline +
-                        '.*$', kk + '=' + v, conffile))
-                break
-        else:
-            if v != 'n':
-                open(conffile, 'a').write(kk + '=' + v + '\n')
+def _kernel_release(c):
+    with c.cd(c.linux_src):
+        return c.run('make -s kernelrelease', hide='both').stdout.strip()
+
+def _reconnect(c, boot_id, timeout=600):
+    # Poll with exponential backoff until the host is back in another boot
+    c.close()
+    t, delay = time.time(), 1
+    orig = c.connect_timeout
+    try:
+        while time.time() - t < timeout:
+            time.sleep(delay)
+            # don't let a half-up host hang the poll on the TCP connect
+            c.connect_timeout = min(delay, 10)
+            try:
+                if _boot_id(c) != boot_id:
+                    print('{}: back after {:.0f}s'.format(c.original_host,
+                        time.time() - t))
+                    return
+            except Exception as e:
+                print('{}: not yet ({})'.format(c.original_host,
+                    type(e).__name__))
+            c.close()
+            delay = min(delay * 2, 30)
+    finally:
+        c.connect_timeout = orig
+    raise Exception('{} did not come back in {}s'.format(c.original_host,
+        timeout))
+
+def _boot_kernel(c, release=None, nokexec=False, load=False, force=False,
+        timeout=600):
+    if not is_linux(c):
+        print('boot_kernel: only Linux is supported')
+        return
+    release = release or _kernel_release(c)
+    if not release.endswith('-fab'):
+        print('{} is not a LOCALVERSION -fab kernel'.format(release))
+    if c.run('uname -r', hide='both').stdout.strip() == release and not force:
+        print('{} already runs {}'.format(c.original_host, release))
+        return
+    boot_id = _boot_id(c)
+
+    # kexec skips the firmware, rebooting is the fallback
+    r = None
+    if not nokexec:
+        r = c.sudo('sh -c \'i=; for f in /boot/initrd.img-{0}'
+                ' /boot/initramfs-{0}.img; do [ -e $f ] && i="--initrd=$f";'
+                ' done; kexec -l /boot/vmlinuz-{0} $i --reuse-cmdline\''
+                .format(release), warn=True, echo=True)
+    how = 'kexec' if r is not None and r.ok else 'reboot'
+    print('{}: {} into {}'.format(c.original_host, how, release))
+    # let the command return before the connection goes away
+    c.sudo('sh -c "nohup sh -c \'sleep 1; systemctl {}\' > /dev/null 2>&1 &"'
+            .format(how), warn=True)
+    _reconnect(c, boot_id, timeout=timeout)
+
+    now = c.run('uname -r', hide='both').stdout.strip()
+    invalidate_facts(c)
+    _hostenv(c)
+    if now != release:
+        raise Exception('{} runs {} instead of {}'.format(c.original_host, now,
+            release))
+    if load:
+        _load_netmap(c)
 
-def config_linux(c, old, debug, trace, opt, pmem, nozstd=False):
+@task
+def boot_kernel(c, host, release=None, nokexec=False, load=False, force=False,
+        timeout=600, par=8):
+    kwargs = dict(release=release, nokexec=nokexec, load=load, force=force,
+            timeout=int(timeout))
+    if _is_multi(host):
+        return _fanout(_boot_kernel, host, par, **kwargs)
+    c = Connection(_host_list(host)[0])
+    _hostenv(c)
+    _boot_kernel(c, **kwargs)
 
+#
+# Build once on a builder host and install the result on identical hosts
+#
+ARTIFACT_DIR = os.path.join(CACHE_DIR, 'artifacts')
+
+# Hash of the sources that affect a build: the git revision with the diff
+# and untracked files of a checkout, otherwise the contents of the sources
+# skipping generated files
+_srchash_cmd = ('{ if git rev-parse -q --verify HEAD 2>/dev/null; then'
+        ' git diff --no-ext-diff --binary HEAD;'
+        ' git ls-files -z -o --exclude-standard | xargs -0r sha1sum;'
+        ' else find . \\( -name .git -o -name generated -o -name "build-*" \\)'
+        ' -prune -o -type f \\( -name "*.[chS]" -o -name "Kconfig*"'
+        ' -o -name "Makefile*" -o -name "Kbuild*" -o -name configure \\)'
+        ' ! -name "*.mod.c" -print0 | sort -z | xargs -0r sha1sum; fi; }'
+        ' | sha1sum')
+
+def _fetch_artifact(c, path):
+    # Pull an artifact from the builder into the local cache
+    local = os.path.join(ARTIFACT_DIR, os.path.basename(path))
+    if not os.path.exists(local):
+        os.makedirs(ARTIFACT_DIR, exist_ok=True)
+        c.get(path, local + '.part')
+        os.replace(local + '.part', local)
+    return local
+
+def _push_artifact(c, local, path):
+    # Returns False if the host already has the artifact
+    r = c.run('mkdir -p {} && test -e {}'.format(os.path.dirname(path), path),
+            warn=True, hide='both')
+    if r.ok:
+        return False
+    print('uploading {} ({:.1f} MB)'.format(os.path.basename(path),
+        os.path.getsize(local) / 1e6))
+    c.put(local, path + '.part')
+    c.run('mv {0}.part {0}'.format(path))
+    return True
+
+def _package_linux(c):
+    # bzImage, System.map, .config and modules of the built tree
     with c.cd(c.linux_src):
-        if old and not _exists(c, '.config'):
-            c.run('cp /boot/config-`uname -r` .config')
-        c.run('yes "" | make olddefconfig')
+        r = c.run('make -s kernelrelease; make -s image_name;'
+                ' sha1sum < .config; {}'.format(_srchash_cmd), hide='both')
+    rel, image, conf, src = [l.split()[0] for l in r.stdout.splitlines()[-4:]]
+    key = _hash_key(src, conf, rel)
+    art = os.path.join(c.workdir, 'artifacts', 'linux-{}-{}.tar.gz'.format(rel,
+        key))
+    stage = os.path.join(c.workdir, 'artifacts', 'stage-' + key)
+    if not _exists(c, art):
+        c.run('mkdir -p {0}/boot && cd {1} && make -s INSTALL_MOD_PATH={0}'
+              ' INSTALL_MOD_STRIP=1 modules_install && cp {2} {0}/boot/vmlinuz-{3}'
+              ' && cp System.map {0}/boot/System.map-{3}'
+              ' && cp .config {0}/boot/config-{3}'
+              ' && tar -C {0} -czf {4} boot lib && rm -rf {0}'.format(stage,
+                  c.linux_src, image, rel, art), echo=True)
+    print('linux artifact {} (src {}, config {})'.format(os.path.basename(art),
+        src[:12], conf[:12]))
+    return {'path': art, 'local': _fetch_artifact(c, art), 'key': key,
+            'release': rel}
+
+def _install_linux_artifact(c, art):
+    rel, key = art['release'], art['key']
+    stamp = '/lib/modules/{}/.fab-artifact'.format(rel)
+    r = c.run('cat {}'.format(stamp), warn=True, hide='both')
+    if r.stdout.strip() == key:
+        print('linux {} ({}) is already installed'.format(rel, key))
+        return
+    path = os.path.join(c.workdir, 'artifacts', os.path.basename(art['path']))
+    _push_artifact(c, art['local'], path)
+    stage = os.path.join(c.workdir, 'artifacts', 'stage-' + key)
+    # same steps as modules_install and install of the kernel Makefile
+    c.sudo('bash -c "rm -rf {0} && mkdir -p {0} && tar -C {0} -xzf {1}'
+           ' && rm -rf /lib/modules/{2} && cp -a {0}/lib/modules/{2} /lib/modules/'
+           ' && depmod {2} && cp {0}/boot/config-{2} /boot/'
+           ' && installkernel {2} {0}/boot/vmlinuz-{2} {0}/boot/System.map-{2} /boot'
+           ' && echo {3} > {4} && rm -rf {0}"'.format(stage, path, rel, key,
+               stamp), echo=True)
+
+def _package_netmap(c):
+    # netmap.ko, driver modules, libnetmap and apps of the built tree
+    with c.cd(c.netmap_src):
+        r = c.run('cat {}/include/config/kernel.release;'
+                ' cat config.status netmap_linux_config.h 2>/dev/null | sha1sum;'
+                ' {}'.format(c.linux_src, _srchash_cmd), hide='both')
+    rel, conf, src = [l.split()[0] for l in r.stdout.splitlines()[-3:]]
+    key = _hash_key(src, conf, rel)
+    art = os.path.join(c.workdir, 'artifacts', 'netmap-{}-{}.tar.gz'.format(rel,
+        key))
+    if not _exists(c, art):
+        with c.cd(c.netmap_src):
+            c.run('mkdir -p {0} && find . -type f \\( -name "*.ko" -o -name "*.a"'
+                  ' -o \\( -path "./build-apps/*" -perm -u+x \\) \\)'
+                  ' | tar -czf {1} -T -'.format(os.path.dirname(art), art),
+                  echo=True)
+    print('netmap artifact {} (src {}, config {})'.format(
+        os.path.basename(art), src[:12], conf[:12]))
+    return {'path': art, 'local': _fetch_artifact(c, art), 'key': key,
+            'release': rel}
+
+def _install_netmap_artifact(c, art, noload=False, debug=False):
+    rel = c.run('uname -r', hide='both').stdout.strip()
+    if rel != art['release']:
+        raise Exception('netmap is built for {}, but {} runs {}'.format(
+            art['release'], c.original_host, rel))
+    path = os.path.join(c.workdir, 'artifacts', os.path.basename(art['path']))
+    _push_artifact(c, art['local'], path)
+    c.run('mkdir -p {0} && tar -C {0} -xzf {1}'.format(c.netmap_src, path),
+            echo=True)
+    if not noload:
+        _load_netmap(c, debug=debug)
+
+@task
+def deploy_linux(c, builder, hosts, src=None, config=False, old=True,
+        debug=False, kdiff=False, ccache=False, par=8):
+    bc = Connection(builder)
+    _hostenv(bc)
+    _make_linux(bc, src=src, config=config, old=old, debug=debug, kdiff=kdiff,
+            ccache=ccache)
+    art = _package_linux(bc)
+    peers = ','.join(h for h in _host_list(hosts) if h != builder)
+    if peers:
+        _fanout(_install_linux_artifact, peers, par, art=art)
+        _copy_build(builder, _host_list(peers), 'linux')
+
+@task
+def deploy_netmap(c, builder, hosts, src=None, config=False, debug=False,
+        noload=False, apps='pkt-gen,vale-ctl', ccache=False, par=8):
+    bc = Connection(builder)
+    _hostenv(bc)
+    _make_netmap(bc, src=src, config=config, debug=debug, noload=noload,
+            apps=apps, ccache=ccache)
+    art = _package_netmap(bc)
+    peers = ','.join(h for h in _host_list(hosts) if h != builder)
+    if peers:
+        _fanout(_install_netmap_artifact, peers, par, art=art, noload=noload,
+                debug=debug)
+        _copy_build(builder, _host_list(peers), 'netmap')
+
+def _read_kconfig(conffile):
+    # Returns the lines and the line number of each option in them
+    with open(conffile) as f:
+        lines = f.read().splitlines()
+    index = {}
+    for n, l in enumerate(lines):
+        m = re.match(r'(?:# )?CONFIG_(\w+)(?:=| is not set$)', l)
+        if m:
+            index[m.group(1)] = n
+    return lines, index
+
+def update_kconfig(c, d, conffile, showdiff=False):
+    lines, index = _read_kconfig(conffile)
+    orig = list(lines)
+    for k, v in d.items():
+        kk = 'CONFIG_' + k
+        l = '# {} is not set'.format(kk) if v == 'n' else '{}={}'.format(kk, v)
+        if k in index:
+            lines[index[k]] = l
+        elif v != 'n':
+            index[k] = len(lines)
+            lines.append(l)
+    changed = [n for n, l in enumerate(orig) if l != lines[n]]
+    print('update_kconfig: {} changed, {} added'.format(len(changed),
+        len(lines) - len(orig)))
+    if showdiff:
+        for l in difflib.unified_diff(orig, lines, conffile, conffile,
+                n=0, lineterm=''):
+            print(l)
+    if lines != orig:
+        tmp = conffile + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, conffile)
+    return lines != orig
+
+def config_linux(c, old, debug, trace, opt, pmem, nozstd=False,
+        showdiff=False):
+
     # Let's add LOCALVERSION for pxeboot which doesn't boot with short name
     d = {'LOCALVERSION':'"-fab"'}
     print('nozstd ', nozstd)
@@ -591,17 +1989,474 @@ def config_linux(c, old, debug, trace, opt, pmem, nozstd=False):
     emptyconfigs = {'SYSTEM_TRUSTED_KEYS':'""', 'SYSTEM_REVOCATION_KEYS':'""'}
     d.update(emptyconfigs)
 
+    # Skip if .config is what the same overrides produced last time and no
+    # Kconfig file has changed since
+    stamp = c.linux_src.rstrip('/') + '.config-stamp'
+    key = hashlib.sha1(json.dumps(d, sort_keys=True).encode()).hexdigest()
+    with c.cd(c.linux_src):
+        r = c.run('echo "@@stamp $(cat {} 2>/dev/null)";'
+                  ' echo "@@conf $(sha1sum < .config 2>/dev/null)";'
+                  ' echo "@@newer $(find . -name "Kconfig*" -newer .config'
+                  ' -print -quit 2>/dev/null)"'.format(stamp),
+                  hide='both', warn=True)
+    st = dict((l.split(' ', 1) + [''])[:2] for l in r.stdout.splitlines())
+    conf = st.get('@@conf', '').split(' ')[0]
+    if (conf and st.get('@@stamp') == '{} {}'.format(key, conf)
+            and not st.get('@@newer')):
+        print('config_linux: .config is up to date')
+        return
+
+    # Work on a copy so that .config keeps its mtime if nothing changes
+    tmpconf = '.config.fab'
+    with c.cd(c.linux_src):
+        if old and not _exists(c, '.config'):
+            c.run('cp /boot/config-`uname -r` .config')
+        c.run('if [ -e .config ]; then cp -p .config {0}; else rm -f {0}; fi;'
+              ' yes "" | KCONFIG_CONFIG={0} make olddefconfig'.format(tmpconf))
     conffile = '.config'
-    c.get(os.path.join(c.linux_src, conffile))
-    update_kconfig(c, d, conffile)
-    c.put(conffile, os.path.join(c.linux_src, conffile))
+    c.get(os.path.join(c.linux_src, tmpconf), conffile)
+    update_kconfig(c, d, conffile, showdiff=showdiff)
+    c.put(conffile, os.path.join(c.linux_src, tmpconf))
 
     with c.cd(c.linux_src):
-        c.run("make olddefconfig")
+        c.run("KCONFIG_CONFIG={} make olddefconfig".format(tmpconf))
+        r = c.run('rm -f {0}.old; if cmp -s {0} .config; then rm {0};'
+                  ' else mv {0} .config; echo changed; fi'.format(tmpconf))
+        print('config_linux: .config {}'.format('updated' if r.stdout.strip()
+            else 'unchanged'))
+        c.run('echo "{} $(sha1sum < .config | cut -d" " -f1)" > {}'.format(
+            key, stamp))
 
 def run_bg(c, cmd, sockname='dtach'):
     return c.run('dtach -n `mktemp -u /tmp/%s.XXXX` %s' % (sockname, cmd))
 
+BENCH_RESULTS = os.path.join(CACHE_DIR, 'bench.jsonl')
+
+def _pktgen(c):
+    return os.path.join(c.netmap_src, 'build-apps', 'pkt-gen', 'pkt-gen')
+
+def _pktgen_pin(c, ifname, threads):
+    # pkt-gen -a pins thread N to the Nth CPU from the given one, otherwise
+    # confine the threads to the planned CPUs
+    plan = _pin_plan(host_facts(c), ifname, threads, threads)
+    _print_plan(plan)
+    t = plan['threads']
+    if t == list(range(t[0], t[0] + len(t))):
+        return '', '-a {}'.format(t[0])
+    return 'taskset -c {} '.format(','.join(str(x) for x in t)), ''
+
+def _parse_pktgen(out):
+    # Speed: 14.880 Mpps Bandwidth: 7.142 Gbps (raw 9.999 Gbps)
+    mul = {'': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9}
+    m = re.findall(r'Speed: ([\d.]+) ([KMG]?)pps Bandwidth: ([\d.]+) ([KMG]?)bps',
+            out)
+    if not m:
+        return None, None
+    pps, pu, bps, bu = m[-1]
+    return float(pps) * mul[pu], float(bps) * mul[bu]
+
+def _bench_info(c, ifname):
+    return {'host': c.original_host, 'if': ifname, 'facts': host_facts(c),
+            'nic_profiles': c.nic_profiles,
+            'build': _load_build_info().get(c.original_host, {}),
+            'tuning': host_tuning(c)}
+
+def _bench_pktgen(tx, rx, txif, rxif, size=60, threads=1, duration=10):
+    # One pkt-gen run from tx to rx. Both are set-up Connections.
+    dmac = rx.run('cat /sys/class/net/{}/address'.format(rxif),
+            hide='both').stdout.strip()
+    saddr = tx.ifs_addr[txif].split('/')[0]
+    daddr = rx.ifs_addr[rxif].split('/')[0]
+    log = '/tmp/pkt-gen-rx.{}.log'.format(os.getpid())
+    pid = '/tmp/pkt-gen-rx.{}.pid'.format(os.getpid())
+
+    # the receiver runs detached, where no password can be given to sudo
+    if not rx.run('sudo -n true', warn=True, hide='both').ok:
+        raise Exception('{}: the pkt-gen receiver needs sudo without a'
+                ' password'.format(rx.original_host))
+    pin = _pktgen_pin(rx, rxif, threads)
+    rxcmd = '{}{} -i {} -f rx -p {} {}'.format(pin[0], _pktgen(rx), rxif,
+            threads, pin[1])
+    # receiver stops by itself a bit after the transmitter, and the pid
+    # file tells which process is ours
+    rx.run('sudo -n rm -f {} {}'.format(pid, log), warn=True, hide='both')
+    run_bg(rx, 'sudo -n sh -c \'echo $$ > {}; exec timeout -s INT {} {} > {}'
+            ' 2>&1\''.format(pid, int(duration) + 5, rxcmd, log),
+            sockname='pkt-gen')
+    if _wait_ready(rx, [('pid', pid)], timeout=10, warn=True):
+        r = rx.run('cat {}'.format(log), warn=True, hide='both')
+        raise Exception('{}: pkt-gen receiver did not start: {}'.format(
+            rx.original_host, r.stdout.strip()))
+    pin = _pktgen_pin(tx, txif, threads)
+    txcmd = ('{}{} -i {} -f tx -l {} -p {} {} -s {}:{} -d {}:{} -D {}'
+            .format(pin[0], _pktgen(tx), txif, size, threads, pin[1], saddr,
+                def_ports[0], daddr, def_ports[1], dmac))
+    r = tx.sudo('timeout -s INT {} {}'.format(duration, txcmd), hide='both',
+            warn=True)
+    txpps, txbps = _parse_pktgen(r.stdout + r.stderr)
+    r = rx.run('while [ -d /proc/$(cat {0}) ]; do sleep 0.2; done;'
+            ' cat {1}; sudo -n rm -f {0} {1}'.format(pid, log), hide='both',
+            warn=True)
+    rxpps, rxbps = _parse_pktgen(r.stdout)
+
+    return {'time': time.time(), 'size': int(size), 'threads': int(threads),
+            'duration': int(duration), 'tx': _bench_info(tx, txif),
+            'rx': _bench_info(rx, rxif), 'tx_pps': txpps, 'tx_bps': txbps,
+            'rx_pps': rxpps, 'rx_bps': rxbps}
+
+def _save_bench(rec, out=None):
+    out = out or BENCH_RESULTS
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with _cache_lock, open(out, 'a') as f:
+        f.write(json.dumps(rec, sort_keys=True) + '\n')
+    _store_result(rec)
+
+#
+# Results of all the benchmark runs, tagged with what has been measured
+#
+RESULTS_DB = os.path.join(CACHE_DIR, 'results.sqlite')
+
+def _results_db():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    db = sqlite3.connect(RESULTS_DB)
+    db.execute('CREATE TABLE IF NOT EXISTS results (time REAL, bench TEXT,'
+            ' host TEXT, peer TEXT, profiles TEXT, size INTEGER,'
+            ' threads INTEGER, tag TEXT, kernel TEXT, tx_pps REAL,'
+            ' rx_pps REAL, tx_bps REAL, rx_bps REAL, record TEXT)')
+    return db
+
+def _result_tag(rec):
+    # netmap and kernel revisions and a hash of the configs of both sides
+    b = [rec[k]['build'] for k in ('tx', 'rx')]
+    get = lambda d, w, k: (d.get(w) or {}).get(k) or '-'
+    return '{}/{}/{}'.format(get(b[0], 'netmap', 'rev'),
+            get(b[0], 'linux', 'rev'), _hash_key(*[get(d, w, 'config')
+                for d in b for w in ('netmap', 'linux')])[:8])
+
+def _store_result(rec, bench='pktgen'):
+    with _cache_lock, _results_db() as db:
+        db.execute('INSERT INTO results VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                (rec['time'], bench, rec['tx']['host'], rec['rx']['host'],
+                 ','.join(rec['tx']['nic_profiles']), rec['size'],
+                 rec['threads'], _result_tag(rec),
+                 rec['tx']['facts'].get('release'), rec['tx_pps'],
+                 rec['rx_pps'], rec['tx_bps'], rec['rx_bps'],
+                 json.dumps(rec, sort_keys=True)))
+    db.close()
+
+def _median_ci(xs):
+    # median and its ~95% confidence interval from order statistics
+    xs = sorted(xs)
+    n = len(xs)
+    med = (xs[(n - 1) // 2] + xs[n // 2]) / 2.0
+    h = 1.96 * math.sqrt(n) / 2
+    j = max(1, int(math.floor(n / 2.0 - h)))
+    k = min(n, int(math.ceil(1 + n / 2.0 + h)))
+    return med, xs[j - 1], xs[k - 1]
+
+@task
+def compare(c, host=None, base=None, new=None, metric='rx_pps', threshold=5):
+    # base and new are prefixes of tags, the two latest ones by default
+    if metric not in ('tx_pps', 'rx_pps', 'tx_bps', 'rx_bps'):
+        raise Exception('Unknown metric {}'.format(metric))
+    db = _results_db()
+    cond, args = ('WHERE host = ?', (host,)) if host else ('', ())
+    tags = [t for t, in db.execute('SELECT tag FROM results {} GROUP BY tag'
+        ' ORDER BY MAX(time) DESC'.format(cond), args)]
+    pick = lambda p: next((t for t in tags if t.startswith(p)), None)
+    new = pick(new) if new else (tags[0] if tags else None)
+    base = pick(base) if base else next((t for t in tags if t != new), None)
+    if not base or not new:
+        print('compare: need two tags, have {}'.format(tags))
+        return
+    runs = {}
+    for row in db.execute('SELECT tag, host, peer, profiles, size, threads,'
+            ' {} FROM results WHERE tag IN (?, ?) AND {} IS NOT NULL'.format(
+                metric, metric), (base, new)):
+        runs.setdefault(row[1:-1], {}).setdefault(row[0], []).append(row[-1])
+    db.close()
+
+    print('compare {}: {} -> {}'.format(metric, base, new))
+    bad = 0
+    for k in sorted(runs):
+        if base not in runs[k] or new not in runs[k]:
+            continue
+        b, n = _median_ci(runs[k][base]), _median_ci(runs[k][new])
+        d = 100.0 * (n[0] - b[0]) / b[0] if b[0] else 0
+        flag = ''
+        if d < -float(threshold):
+            bad += 1
+            flag = 'REGRESSION' if n[2] < b[1] else 'regression? (CIs overlap)'
+        print('{} -> {} {} {}B x{}: {:.4g} [{:.4g}, {:.4g}] n={} -> {:.4g}'
+              ' [{:.4g}, {:.4g}] n={} {:+.1f}% {}'.format(k[0], k[1], k[2],
+                  k[3], k[4], b[0], b[1], b[2], len(runs[k][base]), n[0], n[1],
+                  n[2], len(runs[k][new]), d, flag))
+    if bad:
+        raise Exception('{} point(s) regressed more than {}%'.format(bad,
+            threshold))
+
+def _bench_line(rec):
+    f = lambda v, d: '-' if v is None else '{:.3f}'.format(v / d)
+    return '{:>5}B x{} {}s  tx {} Mpps {} Gbps  rx {} Mpps {} Gbps'.format(
+            rec['size'], rec['threads'], rec['duration'],
+            f(rec['tx_pps'], 1e6), f(rec['tx_bps'], 1e9),
+            f(rec['rx_pps'], 1e6), f(rec['rx_bps'], 1e9))
+
+@task
+def bench_pktgen(c, tx, rx, txif=None, rxif=None, sizes='60', threads=1,
+        duration=10, repeat=1, out=None):
+    tc = _hostenv(Connection(tx))
+    rc = _hostenv(Connection(rx))
+    txif = txif or tc.ifs[0]
+    rxif = rxif or rc.ifs[0]
+    for size in sizes.split(','):
+        for i in range(int(repeat)):
+            rec = _bench_pktgen(tc, rc, txif, rxif, size, int(threads),
+                    int(duration))
+            _save_bench(rec, out)
+            print('{} {} -> {} {}: {}'.format(tx, txif, rx, rxif,
+                _bench_line(rec)))
+
+SWEEP_RESULTS = os.path.join(CACHE_DIR, 'sweep.jsonl')
+
+def _sweep_profiles(c, profiles):
+    # 'common' first, and mq unless the set fixes the queue count itself
+    ps = [p for p in profiles.split('+') if p]
+    if 'common' not in ps:
+        ps.insert(0, 'common')
+    if not any('ethtool -L' in cmd for p in ps
+            for cmd in c.nic_all_profiles.get(p, [])):
+        ps.append('mq')
+    return ps
+
+def _sweep_apply(c, point):
+    # hostenv defaults plus the profiles, queues and sizing of point
+    hostenv(c)
+    c.nrings = point['queues']
+    c.nic_profiles = _sweep_profiles(c, point['profiles'])
+    if point['sizing'] == 'default':
+        c.nosizing = True
+    else:
+        c.config.pop('nosizing', None)
+    # what would be applied, points with the same one are equivalent
+    return sorted(_ifcmd(c, cmd, i) for i in c.ifs for p in c.nic_profiles
+            for cmd in c.nic_all_profiles.get(p, [])) + [point['sizing']]
+
+def _point_str(point):
+    return '{} q{} {} {}B'.format(point['profiles'], point['queues'],
+            point['sizing'], point['size'])
+
+@task
+def sweep(c, tx, rx, profiles='onload+noim,offload+noim', queues='1',
+        sizes='60', sizing='auto', threads=1, duration=10, out=None,
+        resume=False):
+    # profiles are comma-separated sets of '+'-joined nic_all_profiles.
+    # Results are appended to out, and with resume the points already there
+    # are not run again.
+    out = out or SWEEP_RESULTS
+    tc = _hostenv(Connection(tx))
+    rc = _hostenv(Connection(rx))
+    txif, rxif = tc.ifs[0], rc.ifs[0]
+    done = {}
+    if resume:
+        try:
+            with open(out) as f:
+                for l in f:
+                    rec = json.loads(l)
+                    done[rec['sig']] = rec
+        except OSError:
+            pass
+        print('sweep: resuming with {} point(s) done'.format(len(done)))
+
+    table = []
+    applied = None
+    for p, q, z in itertools.product(profiles.split(','), queues.split(','),
+            sizing.split(',')):
+        point = {'profiles': p, 'queues': int(q), 'sizing': z}
+        cfg = _hash_key(json.dumps([_sweep_apply(cx, point)
+            for cx in (tc, rc)]))
+        for size in sizes.split(','):
+            pt = dict(point, size=int(size))
+            sig = _hash_key(cfg, size, str(threads), str(duration))
+            if sig in done:
+                prev = done[sig]['point']
+                print('sweep: {} {}'.format(_point_str(pt), 'done'
+                    if prev == pt else 'same as ' + _point_str(prev)))
+                table.append((pt, done[sig]))
+                continue
+            try:
+                if applied != cfg:
+                    applied = None
+                    for cx in tc, rc:
+                        _load_netmap(cx)
+                    applied = cfg
+                rec = _bench_pktgen(tc, rc, txif, rxif, size, int(threads),
+                        int(duration))
+            except Exception as e:
+                print('sweep: {} failed: {!r}'.format(_point_str(pt), e))
+                continue
+            rec.update(point=pt, sig=sig)
+            _save_bench(rec, out)
+            done[sig] = rec
+            table.append((pt, rec))
+            print('sweep: {}: {}'.format(_point_str(pt), _bench_line(rec)))
+
+    # fastest point of each packet size first
+    table.sort(key=lambda t: (t[0]['size'], -(t[1]['rx_pps'] or 0)))
+    print('{:<32} {:>4} {:<8} {:>5} {:>10} {:>10}'.format('profiles', 'q',
+        'sizing', 'size', 'tx Mpps', 'rx Mpps'))
+    for pt, rec in table:
+        print('{:<32} {:>4} {:<8} {:>5} {:>10.3f} {:>10.3f}'.format(
+            pt['profiles'], pt['queues'], pt['sizing'], pt['size'],
+            (rec['tx_pps'] or 0) / 1e6, (rec['rx_pps'] or 0) / 1e6))
+
+#
+# Telemetry sampler running on the host during a run, writing one JSON line
+# of counter deltas per interval
+#
+_TELEMETRY_PY = """
+import json, signal, subprocess, sys, time
+
+def ethtool(i):
+    out = subprocess.run(['ethtool', '-S', i], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    d = {}
+    for l in out.splitlines()[1:]:
+        k, _, v = l.partition(':')
+        if v.strip().isdigit():
+            d[k.strip()] = int(v)
+    return d
+
+def percpu(path, names=None):
+    # /proc/interrupts and /proc/softirqs
+    with open(path) as f:
+        lines = f.read().splitlines()
+    n = len(lines[0].split())
+    d = {}
+    for l in lines[1:]:
+        t = l.split()
+        k = t[0].rstrip(':')
+        if names is None or any(x in l for x in names):
+            d[k] = [int(x) for x in t[1:n + 1] if x.isdigit()]
+    return d
+
+def cpustat():
+    d = {}
+    with open('/proc/stat') as f:
+        for l in f:
+            t = l.split()
+            if t[0].startswith('cpu') and t[0] != 'cpu':
+                v = [int(x) for x in t[1:]]
+                d[t[0][3:]] = [sum(v) - v[3] - v[4], sum(v)]
+    return d
+
+def sample(ifs):
+    return {'eth': dict((i, ethtool(i)) for i in ifs),
+            'irq': percpu('/proc/interrupts', ifs),
+            'softirq': percpu('/proc/softirqs', ['NET_RX', 'NET_TX']),
+            'cpu': cpustat()}
+
+def delta(a, b):
+    if isinstance(b, dict):
+        d = dict((k, delta(a.get(k), v)) for k, v in b.items())
+        return dict((k, v) for k, v in d.items() if v)
+    if isinstance(b, list):
+        a = a or [0] * len(b)
+        d = [y - x for x, y in zip(a, b)]
+        return d if any(d) else None
+    return b - (a or 0)
+
+stop = []
+signal.signal(signal.SIGTERM, lambda *a: stop.append(1))
+signal.signal(signal.SIGINT, lambda *a: stop.append(1))
+interval, out, ifs = float(sys.argv[1]), sys.argv[2], sys.argv[3:]
+prev, pt = sample(ifs), time.time()
+with open(out, 'w') as f:
+    while not stop:
+        time.sleep(interval)
+        cur, t = sample(ifs), time.time()
+        f.write(json.dumps({'t': round(t, 3), 'dt': round(t - pt, 3),
+            'd': delta(prev, cur)}, separators=(',', ':')) + '\\n')
+        f.flush()
+        prev, pt = cur, t
+"""
+TELEMETRY_DIR = os.path.join(CACHE_DIR, 'telemetry')
+
+def _telemetry_paths(c):
+    return ('/tmp/fab-telemetry.py',
+            '/tmp/fab-telemetry.{}.jsonl'.format(c.user))
+
+# matches the sampler but not the shell running pkill/pgrep with it
+_telemetry_pat = '"python3 [/]tmp/fab-telemetry.py"'
+
+def _telemetry_start(c, interval=1.0, ifs=None):
+    script, out = _telemetry_paths(c)
+    c.put(io.StringIO(_TELEMETRY_PY), script)
+    c.run('pkill -f {}; rm -f {}'.format(_telemetry_pat, out), warn=True,
+            hide='both')
+    run_bg(c, 'python3 {} {} {} {}'.format(script, interval, out,
+        ' '.join(ifs or c.ifs)), sockname='telemetry')
+
+# rx_queue_0_packets (ixgbe, ice), rx-0.packets (i40e), rx0_packets (mlx5)
+_queue_stat = re.compile(r'^(rx|tx)(?:_queue_|-)?(\d+)[._](\w+)$')
+
+def _telemetry_series(recs):
+    # per-queue, per-IRQ, per-CPU softirq and CPU busy rates over time
+    series = {'queues': {}, 'irqs': {}, 'softirqs': {}, 'cpu': {}}
+    t0 = recs[0]['t'] - recs[0]['dt'] if recs else 0
+    for r in recs:
+        t, dt, d = round(r['t'] - t0, 3), r['dt'], r['d']
+        add = lambda k, n, v: series[k].setdefault(n, []).append(
+                (t, round(v / dt, 1)))
+        for i, st in d.get('eth', {}).items():
+            for k, v in st.items():
+                m = _queue_stat.match(k)
+                if m:
+                    add('queues', '{} {}{} {}'.format(i, *m.groups()), v)
+        for irq, v in d.get('irq', {}).items():
+            add('irqs', irq, sum(v))
+        for k, v in d.get('softirq', {}).items():
+            for cpu, x in enumerate(v):
+                if x:
+                    add('softirqs', '{} cpu{}'.format(k, cpu), x)
+        for cpu, (busy, total) in d.get('cpu', {}).items():
+            series['cpu'].setdefault('cpu' + cpu, []).append(
+                    (t, round(100.0 * busy / total, 1) if total else 0))
+    return series
+
+def _telemetry_stop(c, out=None):
+    script, rout = _telemetry_paths(c)
+    c.run('pkill -f {0}; while pgrep -f {0} > /dev/null; do sleep 0.1; done'
+            .format(_telemetry_pat), warn=True, hide='both')
+    buf = io.BytesIO()
+    c.get(rout, buf)
+    recs = [json.loads(l) for l in buf.getvalue().decode().splitlines() if l]
+    series = _telemetry_series(recs)
+    if not out:
+        os.makedirs(TELEMETRY_DIR, exist_ok=True)
+        out = os.path.join(TELEMETRY_DIR, '{}-{}.json'.format(c.original_host,
+            time.strftime('%Y%m%d-%H%M%S')))
+    with open(out, 'w') as f:
+        json.dump(dict(series, host=c.original_host), f)
+
+    print('telemetry: {} samples to {}'.format(len(recs), out))
+    for k in 'queues', 'irqs':
+        for n, v in sorted(series[k].items()):
+            rates = [x for _, x in v]
+            print('  {:<32} mean {:>12.1f}/s max {:>12.1f}/s'.format(n,
+                sum(rates) / len(recs), max(rates)))
+    return series
+
+@task
+def telemetry_start(c, host, interval=1.0, ifs=None):
+    c = ensure_connected(c, host)
+    _telemetry_start(c, interval, ifs.split(',') if ifs else None)
+
+@task
+def telemetry_stop(c, host, out=None):
+    c = ensure_connected(c, host)
+    _telemetry_stop(c, out)
+
 @task
 def start_dgraph(c, host, mem='2048', nozero=False, noalpha=False,
         noratel=False):
@@ -719,8 +2574,8 @@ def _make_freebsd(c, host=None, src=None, config=False, debug=False):
     if not debug:
         fbsd_config += '-NODEBUG'
     with c.cd(c.fbsd_src):
-        c.run('make -j{} buildkernel {} KERNCONF={}'.format(c.ncpus+1,
-            build_args, fbsd_config))
+        _make(c, 'buildkernel {} KERNCONF={}'.format(build_args, fbsd_config),
+                'freebsd buildkernel')
     # sudo doesn't work with cd...
     c.sudo('bash -c "cd {} && make installkernel KERNCONF={}"'.format(c.fbsd_src,
         fbsd_config))
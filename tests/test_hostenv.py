@@ -0,0 +1,27 @@
+import pytest
+
+import hostenv
+
+GB = 2**30
+
+def test_netmap_priv_sizing():
+    nics = {'enp129s0f0': {'rxq': 4, 'txq': 4, 'slots': 2048, 'node': 1}}
+    sizing, why = hostenv.netmap_priv_sizing(8, nics, {0: 8 * GB, 1: 4 * GB})
+    assert sizing == {'priv_if_num': 16, 'priv_ring_num': 42,
+            'priv_ring_size': 33024,
+            'priv_buf_num': 42 * 2048 + 8 * hostenv.NM_EXTRA_BUFS}
+    assert len(why) == 5
+    assert 'node(s) [1]' in why[-1]
+
+def test_netmap_priv_sizing_largest_ring():
+    nics = {'a': {'rxq': 1, 'txq': 1, 'slots': 512, 'node': -1},
+            'b': {'rxq': 1, 'txq': 1, 'slots': 4096, 'node': -1},
+            'c': {'rxq': 1, 'txq': 1, 'slots': None, 'node': -1}}
+    sizing, why = hostenv.netmap_priv_sizing(2, nics, {-1: 16 * GB})
+    assert sizing['priv_ring_size'] == 256 + 16 * 4096
+
+def test_netmap_priv_sizing_low_memory():
+    nics = {'enp129s0f0': {'rxq': 4, 'txq': 4, 'slots': 2048, 'node': 1}}
+    # plenty on node 0, but the NIC's node is short
+    with pytest.raises(Exception, match='netmap needs'):
+        hostenv.netmap_priv_sizing(8, nics, {0: 64 * GB, 1: 256 * 2**20})
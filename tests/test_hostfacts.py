@@ -0,0 +1,92 @@
+import hostfacts
+
+# facts_script output captured from a 2-socket host with SMT and an ixgbe NIC
+# on node 1 (only the first ethtool -i lines are kept)
+FACTS = '''@@sys Linux 6.8.0-fab
+@@boot_id 5b1f3c2e-9a8d-4c1e-8f0a-2d6b7e9c1a34
+@@ncpus 8
+@@cpu 0 0 0 0 0,4
+@@cpu 1 1 0 0 1,5
+@@cpu 2 0 1 1 2,6
+@@cpu 3 1 1 1 3,7
+@@cpu 4 0 0 0 0,4
+@@cpu 5 1 0 0 1,5
+@@cpu 6 0 1 1 2,6
+@@cpu 7 1 1 1 3,7
+@@if enp129s0f0
+mac 90:e2:ba:12:34:56
+node 1
+speed 10000
+pci 0000:81:00.0
+pcie 8 5.0 GT/s PCIe
+addr inet 192.168.11.2/24
+addr inet6 fe80::92e2:baff:fe12:3456/64
+i driver: ixgbe
+i version: 6.8.0-fab
+i firmware-version: 0x800003df
+i bus-info: 0000:81:00.0
+l Channel parameters for enp129s0f0:
+l Pre-set maximums:
+l RX:		n/a
+l TX:		n/a
+l Other:		1
+l Combined:	63
+l Current hardware settings:
+l RX:		n/a
+l TX:		n/a
+l Other:		1
+l Combined:	4
+g Ring parameters for enp129s0f0:
+g Pre-set maximums:
+g RX:			4096
+g RX Mini:		n/a
+g RX Jumbo:		n/a
+g TX:			4096
+g Current hardware settings:
+g RX:			512
+g RX Mini:		n/a
+g RX Jumbo:		n/a
+g TX:			512
+@@if eno1
+mac 0c:c4:7a:00:11:22
+node -1
+speed -1
+pci 0000:00:19.0
+pcie  
+i driver: e1000e
+'''
+
+def test_parse_facts_host():
+    f = hostfacts.parse_facts(FACTS)
+    assert (f['ostype'], f['release'], f['ncpus']) == ('Linux', '6.8.0-fab',
+            8)
+    assert f['boot_id'] == '5b1f3c2e-9a8d-4c1e-8f0a-2d6b7e9c1a34'
+    assert [x['cpu'] for x in f['cpus']] == list(range(8))
+    assert f['cpus'][6] == {'cpu': 6, 'core': 0, 'socket': 1, 'node': 1,
+            'siblings': '2,6'}
+    assert f['nodes'] == {'0': [0, 1, 4, 5], '1': [2, 3, 6, 7]}
+
+def test_parse_facts_nics():
+    nics = hostfacts.parse_facts(FACTS)['nics']
+    n = nics['enp129s0f0']
+    assert (n['driver'], n['firmware'], n['node'], n['speed']) == ('ixgbe',
+            '0x800003df', 1, 10000)
+    assert n['pcie'] == {'width': 8, 'speed': '5.0 GT/s'}
+    assert n['queues']['combined'] == 4
+    assert n['max_queues']['combined'] == 63
+    assert n['queues']['rx'] is None
+    assert (n['rings']['rx'], n['max_rings']['rx']) == (512, 4096)
+    assert n['addrs'][0] == {'family': 'inet', 'addr': '192.168.11.2/24'}
+    # no ethtool -l/-g and no PCIe link
+    e = nics['eno1']
+    assert (e['driver'], e['node'], e['queues']) == ('e1000e', -1, {})
+    assert e['pcie'] == {'width': None, 'speed': None}
+
+def test_nic_lookup():
+    f = hostfacts.parse_facts(FACTS)
+    assert hostfacts.nic_by_driver(f, ['e1000e', 'ixgbe']) == ('eno1',
+            'e1000e')
+    assert hostfacts.nic_by_addr(f, '192.168.11.') == ('enp129s0f0',
+            'ixgbe', '192.168.11.2/24')
+    assert hostfacts.nic_by_addr(f, '10.') is None
+    assert hostfacts.nic_by_driver(f, ['mlx5_core']) is None
@@ -0,0 +1,305 @@
+import subprocess
+
+import invoke
+import pytest
+
+import tasks
+
+# ethtool 5.x output captured from an ixgbe NIC
+ETHTOOL_K = '''Features for enp1s0f0:
+rx-checksumming: on
+tx-checksumming: on
+	tx-checksum-ipv4: off [fixed]
+	tx-checksum-ip-generic: on
+scatter-gather: on
+tcp-segmentation-offload: on
+generic-receive-offload: on
+large-receive-offload: off
+rx-vlan-filter: on [fixed]
+ntuple-filters: off
+'''
+
+ETHTOOL_C = '''Coalesce parameters for enp1s0f0:
+Adaptive RX: on  TX: off
+stats-block-usecs: 0
+sample-interval: 0
+
+rx-usecs: 1
+rx-frames: 0
+tx-usecs: 0
+tx-frames: 0
+'''
+
+ETHTOOL_L = '''Channel parameters for enp1s0f0:
+Pre-set maximums:
+RX:		0
+TX:		0
+Other:		1
+Combined:	63
+Current hardware settings:
+RX:		0
+TX:		0
+Other:		1
+Combined:	8
+'''
+
+ETHTOOL_A = '''Pause parameters for enp1s0f0:
+Autonegotiate:	on
+RX:		on
+TX:		off
+'''
+
+def _state():
+    return {'enp1s0f0': {
+        '-K': tasks._parse_ethtool('-K', ETHTOOL_K),
+        '-C': tasks._parse_ethtool('-C', ETHTOOL_C),
+        '-L': tasks._parse_ethtool('-L', ETHTOOL_L),
+        '-A': tasks._parse_ethtool('-A', ETHTOOL_A),
+        'link': ['BROADCAST', 'MULTICAST', 'UP', 'LOWER_UP'],
+    }}
+
+def test_parse_ethtool_features():
+    st = tasks._parse_ethtool('-K', ETHTOOL_K)
+    assert st['tcp-segmentation-offload'] == ('on', False)
+    assert st['tx-checksum-ipv4'] == ('off', True)
+    assert st['rx-vlan-filter'] == ('on', True)
+    assert 'Features for enp1s0f0' not in st
+
+def test_parse_ethtool_coalesce():
+    st = tasks._parse_ethtool('-C', ETHTOOL_C)
+    assert st['adaptive-rx'] == 'on'
+    assert st['adaptive-tx'] == 'off'
+    assert st['rx-usecs'] == '1'
+
+def test_parse_ethtool_channels_current():
+    st = tasks._parse_ethtool('-L', ETHTOOL_L)
+    assert st['combined'] == '8'
+    assert st['other'] == '1'
+
+def test_parse_ethtool_pause():
+    assert tasks._parse_ethtool('-A', ETHTOOL_A) == {'autoneg': 'on',
+            'rx': 'on', 'tx': 'off'}
+
+def test_ifcmd_diff_drops_settings_in_place():
+    st = _state()
+    assert tasks._ifcmd_diff('ethtool -K enp1s0f0 tso on gro on', st) == (
+            None, [])
+    assert tasks._ifcmd_diff('ethtool -L enp1s0f0 combined 8', st) == (
+            None, [])
+    assert tasks._ifcmd_diff('ip link set enp1s0f0 up', st) == (None, [])
+
+def test_ifcmd_diff_keeps_changes():
+    st = _state()
+    cmd, changes = tasks._ifcmd_diff(
+            'ethtool -K enp1s0f0 tso off gro on lro on', st)
+    assert cmd == 'ethtool -K enp1s0f0 tso off lro on'
+    assert changes == [('tso', 'on', 'off'), ('lro', 'off', 'on')]
+    # the state follows so the same command is not repeated
+    assert tasks._ifcmd_diff('ethtool -K enp1s0f0 tso off', st) == (None, [])
+
+    cmd, changes = tasks._ifcmd_diff(
+            'ethtool -C enp1s0f0 adaptive-rx off rx-usecs 1', st)
+    assert cmd == 'ethtool -C enp1s0f0 adaptive-rx off'
+    assert changes == [('adaptive-rx', 'on', 'off')]
+
+    cmd, changes = tasks._ifcmd_diff('ip link set enp1s0f0 promisc on', st)
+    assert cmd == 'ip link set enp1s0f0 promisc on'
+    assert changes == [('promisc', 'off', 'on')]
+
+def test_ifcmd_diff_skips_fixed_features():
+    st = _state()
+    assert tasks._ifcmd_diff('ethtool -K enp1s0f0 tx-checksum-ipv4 on',
+            st) == (None, [])
+
+def test_ifcmd_diff_passes_unknown_commands():
+    st = _state()
+    for cmd in ('ethtool -K eth9 tso off', 'ethtool -G enp1s0f0 rx 512',
+            'ip addr add 10.0.0.1/24 dev enp1s0f0'):
+        assert tasks._ifcmd_diff(cmd, st) == (cmd, [])
+
+KCONFIG = '''CONFIG_NET=y
+CONFIG_E100=y
+CONFIG_E1000=m
+# CONFIG_E1000E is not set
+CONFIG_IXGBE=m
+'''
+
+def test_update_kconfig_exact_names(tmp_path):
+    f = tmp_path / '.config'
+    f.write_text(KCONFIG)
+    assert tasks.update_kconfig(None, {'E100': 'n', 'E1000E': 'm',
+        'IGB': 'm', 'PPP': 'n'}, str(f))
+    assert f.read_text().splitlines() == [
+        'CONFIG_NET=y',
+        '# CONFIG_E100 is not set',
+        'CONFIG_E1000=m',
+        'CONFIG_E1000E=m',
+        'CONFIG_IXGBE=m',
+        'CONFIG_IGB=m',
+    ]
+
+def test_update_kconfig_unchanged(tmp_path):
+    f = tmp_path / '.config'
+    f.write_text(KCONFIG)
+    assert not tasks.update_kconfig(None, {'E1000': 'm', 'E1000E': 'n'},
+            str(f))
+    assert f.read_text() == KCONFIG
+
+class FakeConn(object):
+    # answers every run with the same output
+    def __init__(self, ostype, stdout):
+        self.ostype = ostype
+        self.stdout = stdout
+        self.cmds = []
+
+    def run(self, cmd, **kwargs):
+        self.cmds.append(cmd)
+        return invoke.Result(stdout=self.stdout)
+
+def test_make_jobs_cpu_bound():
+    # 32 CPUs, 64 GB available
+    c = FakeConn('Linux', '32\n67108864\n')
+    assert tasks._make_jobs(c) == '-j33 -l32'
+
+def test_make_jobs_memory_bound():
+    # 32 CPUs, 2 GB available
+    c = FakeConn('Linux', '32\n2097152\n')
+    assert tasks._make_jobs(c) == '-j8 -l32'
+    c = FakeConn('Linux', '4\n102400\n')
+    assert tasks._make_jobs(c) == '-j1 -l4'
+
+def test_make_jobs_freebsd():
+    # bmake has no -l, gmake has
+    c = FakeConn('FreeBSD', '16\n33554432\n')
+    assert tasks._make_jobs(c) == '-j17'
+    assert tasks._make_jobs(c, 'gmake') == '-j17 -l16'
+    assert 'v_inactive_count' in c.cmds[0]
+
+# /proc/modules, then the holders in /sys/module; e1000 holds netmap without
+# being listed in its used-by column, bridge is built in
+MODULES = '''ixgbe 462848 0 - Live 0xffffffffc0a1b000
+e1000 155648 0 - Live 0xffffffffc09d2000
+netmap 348160 2 ixgbe, Live 0xffffffffc0940000
+mdio 16384 1 ixgbe, Live 0xffffffffc0935000
+@@
+bridge
+e1000
+ixgbe
+mdio ixgbe
+netmap e1000 ixgbe
+'''
+
+def test_module_graph():
+    graph = tasks._module_graph(FakeConn('Linux', MODULES))
+    assert graph == {'ixgbe': set(), 'e1000': set(),
+            'netmap': {'ixgbe', 'e1000'}, 'mdio': {'ixgbe'}}
+
+def test_unload_order_holders_first():
+    # netmap is held by the patched drivers, ixgbe also by a vale module
+    graph = {'netmap': {'ixgbe', 'e1000'}, 'ixgbe': {'vale_x'},
+            'e1000': set(), 'vale_x': set(), 'mdio': {'ixgbe'}}
+    order = tasks._unload_order(graph, ['netmap', 'notloaded'])
+    assert order == ['e1000', 'vale_x', 'ixgbe', 'netmap']
+
+def test_wait_script(tmp_path, monkeypatch):
+    monkeypatch.setitem(tasks._ready_tests, 'file', '[ -e {0} ]')
+    there, missing = tmp_path / 'there', tmp_path / 'missing'
+    there.write_text('')
+    script = tasks._wait_script([('file', there), ('file', missing)],
+            timeout=0.2)
+    out = subprocess.run(['sh', '-c', script], stdout=subprocess.PIPE,
+            universal_newlines=True).stdout
+    t = [l.split() for l in out.splitlines()]
+    assert [x[:3] for x in t] == [['@@wait', 'file', str(there)],
+            ['@@wait', 'file', str(missing)]]
+    assert t[0][3] == 'ready' and int(t[0][4]) < 200
+    assert t[1][3] == 'timeout' and int(t[1][4]) >= 200
+
+def test_wait_report():
+    out = ('@@wait link ens1f0 ready 1200\n'
+           '@@wait queues ens1f0 8 timeout 30005\n')
+    assert tasks._wait_report(out, warn=True) == ['queues ens1f0 8']
+    with pytest.raises(Exception, match='Not ready: queues ens1f0 8'):
+        tasks._wait_report(out)
+
+# end of a pkt-gen -f rx run
+PKTGEN_RX = '''421.093481 main_thread [2781] 14.880 Mpps (14.895 Mpkts 7.142 Gbps in 1001012 usec) 512.00 avg_batch 0 min_space
+422.094502 main_thread [2781] 14.879 Mpps (14.894 Mpkts 7.142 Gbps in 1001021 usec) 512.00 avg_batch 0 min_space
+Received 148793102 packets 8927586120 bytes 290612 events 60 bytes each in 10.00 seconds.
+Speed: 14.879 Mpps Bandwidth: 7.142 Gbps (raw 9.998 Gbps). Average batch: 512.00 pkts
+'''
+
+def test_parse_pktgen():
+    pps, bps = tasks._parse_pktgen(PKTGEN_RX)
+    assert pps == pytest.approx(14.879e6)
+    assert bps == pytest.approx(7.142e9)
+
+def test_parse_pktgen_units_and_last_summary():
+    out = ('Speed: 812.500 Kpps Bandwidth: 390.000 Mbps (raw 546.000 Mbps)\n'
+           'Speed: 950.000 pps Bandwidth: 456.000 Kbps (raw 638.400 Kbps)\n')
+    assert tasks._parse_pktgen(out) == (950.0, 456000.0)
+
+def test_parse_pktgen_no_summary():
+    assert tasks._parse_pktgen('Received 0 packets\n') == (None, None)
+
+def test_median_ci():
+    assert tasks._median_ci([3.0]) == (3.0, 3.0, 3.0)
+    # even count, unsorted input
+    assert tasks._median_ci([4, 1, 3, 2]) == (2.5, 1, 4)
+    # ranks 7 and 19 of 25
+    xs = [float(x) for x in range(25, 0, -1)]
+    assert tasks._median_ci(xs) == (13.0, 7.0, 19.0)
+
+def test_median_ci_outlier():
+    # one bad run moves neither the median nor the interval much
+    xs = [14.8, 14.9, 14.85, 14.87, 14.82, 14.9, 14.88, 14.86, 14.84, 1.0]
+    med, lo, hi = tasks._median_ci(xs)
+    assert med == pytest.approx(14.855)
+    assert (lo, hi) == (1.0, 14.9)
+    med, lo, hi = tasks._median_ci(xs * 3)
+    assert (lo, hi) == (14.82, 14.88)
+
+# 2 sockets x 2 cores x 2 threads, CPU n + 4 is the SMT sibling of CPU n, and
+# a NIC on node 1
+PIN_FACTS = {'ncpus': 8, 'cpus': [{'cpu': x, 'core': x % 2,
+    'socket': x // 2 % 2, 'node': x // 2 % 2} for x in range(8)],
+    'nics': {'enp129s0f0': {'node': 1}, 'eno1': {'node': -1}}}
+
+def test_pin_plan_colocate():
+    plan = tasks._pin_plan(PIN_FACTS, 'enp129s0f0', 2, 2)
+    assert plan['node'] == 1
+    assert plan['housekeeping'] == [0, 4]
+    assert plan['queues'] == [2, 3]
+    assert plan['threads'] == [2, 3]
+    assert plan['warnings'] == []
+
+def test_pin_plan_separate_threads():
+    plan = tasks._pin_plan(PIN_FACTS, 'enp129s0f0', 4, 2, colocate=False)
+    # physical cores of node 1, their siblings, then node 0 off CPU 0's core
+    assert plan['queues'] == [2, 3, 6, 7]
+    assert plan['threads'] == [1, 5]
+    assert plan['warnings'] == [
+            'queue 2 on CPU 6, SMT sibling of CPU 2',
+            'queue 3 on CPU 7, SMT sibling of CPU 3',
+            'thread 0 on CPU 1 of remote node 0',
+            'thread 1 on CPU 5 of remote node 0']
+
+def test_pin_plan_oversubscribed():
+    plan = tasks._pin_plan(PIN_FACTS, 'eno1', 8, 0)
+    # no NUMA node of the NIC, so that of CPU 0
+    assert plan['node'] == 0
+    assert plan['queues'][:2] == [1, 5]
+    assert plan['warnings'][0] == '8 queues and 0 threads on 6 CPUs,' \
+            ' sharing CPUs'
+
+INTERRUPTS = ''' 145:    1203311          0   IR-PCI-MSI 42991616-edge      enp129s0f0-TxRx-0
+ 146:          0     983120   IR-PCI-MSI 42991617-edge      enp129s0f0-TxRx-1
+ 147:          2          0   IR-PCI-MSI 42991618-edge      enp129s0f0
+ 150:      51020          0   IR-PCI-MSI 409600-edge      eno1
+'''
+
+def test_nic_irqs():
+    irqs = tasks._nic_irqs(FakeConn('Linux', INTERRUPTS), ['enp129s0f0',
+        'eno1'])
+    assert irqs == {'enp129s0f0': [('145', 0), ('146', 1)],
+            'eno1': [('150', None)]}